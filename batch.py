@@ -0,0 +1,22 @@
+import sys
+import argparse
+from gmk.batch import collectInputs, extractAll
+from launch import addOptions, getOptions, setUpLogger
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Extracts many GameMaker data files in parallel, one process each')
+    parser.add_argument('inputs', metavar='<data.win|dir>', nargs='+',
+                        help='data files to extract, dirs are searched for .win, .unx, .ios and .droid files')
+    parser.add_argument('-o', '--output', default='data',
+                        help='base directory, every input gets its own dir inside, it defaults to "data"')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='number of files extracted at the same time, defaults to the number of cores')
+    addOptions(parser)
+    args = parser.parse_args()
+    setUpLogger()
+
+    results = extractAll(collectInputs(args.inputs), args.output, getOptions(args), args.processes)
+    if any(r['error'] is not None for r in results):
+        sys.exit(1)
@@ -0,0 +1,242 @@
+import gmk
+import os
+import io
+import sys
+import json
+import time
+import struct
+import shutil
+import logging
+import argparse
+import tempfile
+from PIL import Image, ImageDraw
+
+log = logging.getLogger('benchmark')
+
+class SyntheticData:
+    # Builds a FORM file with the same layout Section.create and the entry
+    # loaders expect: GEN8, SOND, AUDO, TXTR, TPAG, SPRT and a STRG section
+    # holding every string the other sections point to.
+    def __init__(self, sounds=50, textures=4, sprites=100, frames=4, texture_size=512,
+                 frame_size=32, audio_size=64*1024):
+        self.sounds = sounds
+        self.textures = textures
+        self.sprites = sprites
+        self.frames = frames
+        self.texture_size = texture_size
+        self.frame_size = frame_size
+        self.audio_size = audio_size
+        self.__out = bytearray()
+        self.__strings = [] # (position of the pointer, string)
+
+    def __int(self, v):
+        self.__out.extend(struct.pack('<i', v))
+
+    def __ptr(self, s):
+        self.__strings.append((len(self.__out), s))
+        self.__int(0)
+
+    def __begin(self, tag):
+        self.__out.extend(tag)
+        pos = len(self.__out)
+        self.__int(0)
+        return pos
+
+    def __end(self, pos):
+        struct.pack_into('<i', self.__out, pos, len(self.__out) - pos - 4)
+
+    def __table(self, count):
+        # Writes the count and room for the offsets, returns where they go
+        self.__int(count)
+        pos = len(self.__out)
+        self.__out.extend(bytes(4*count))
+        return pos
+
+    def __setOffset(self, table, i):
+        struct.pack_into('<i', self.__out, table + 4*i, len(self.__out))
+
+    def __texture(self, i):
+        img = Image.new('RGBA', (self.texture_size, self.texture_size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        step = self.frame_size
+        for y in range(0, self.texture_size, step):
+            for x in range(0, self.texture_size, step):
+                color = ((x*7 + i*31) % 256, (y*5 + i*17) % 256, (x + y) % 256, 255)
+                draw.rectangle((x+1, y+1, x+step-2, y+step-2), fill=color)
+        buf = io.BytesIO()
+        img.save(buf, 'PNG')
+        return buf.getvalue()
+
+    def build(self):
+        out = self.__out
+        out.extend(b'FORM')
+        self.__int(0)
+        pos = self.__begin(b'GEN8')
+        out.extend(bytes(16))
+        self.__end(pos)
+
+        pos = self.__begin(b'SOND')
+        table = self.__table(self.sounds)
+        for i in range(self.sounds):
+            self.__setOffset(table, i)
+            self.__ptr('snd_'+str(i))
+            out.extend(b'\x01\x00\x00\x00')
+            self.__ptr('.ogg')
+            self.__ptr('snd_'+str(i)+'.ogg')
+            out.extend(bytes(4 + 8 + 8 + 4)) # effects, volume, pan and preload
+            self.__int(i)
+        self.__end(pos)
+
+        pos = self.__begin(b'AUDO')
+        table = self.__table(self.sounds)
+        for i in range(self.sounds):
+            self.__setOffset(table, i)
+            self.__int(self.audio_size)
+            out.extend(bytes([i % 256])*self.audio_size)
+        self.__end(pos)
+
+        pos = self.__begin(b'TXTR')
+        table = self.__table(self.textures)
+        images = []
+        for i in range(self.textures):
+            self.__setOffset(table, i)
+            self.__int(1)
+            images.append(len(out))
+            self.__int(0)
+        for i, image in enumerate(images):
+            struct.pack_into('<i', out, image, len(out))
+            out.extend(self.__texture(i))
+        self.__end(pos)
+
+        # Frames are laid out in a grid, filling the texture pages in order
+        per_row = self.texture_size // self.frame_size
+        per_page = per_row * per_row
+        count = self.sprites * self.frames
+        pos = self.__begin(b'TPAG')
+        table = self.__table(count)
+        packages = []
+        for i in range(count):
+            self.__setOffset(table, i)
+            packages.append(len(out))
+            cell = i % per_page
+            size = self.frame_size
+            out.extend(struct.pack('<11h', (cell % per_row)*size, (cell // per_row)*size, size, size,
+                                   0, 0, size, size, size, size, (i // per_page) % self.textures))
+        self.__end(pos)
+
+        pos = self.__begin(b'SPRT')
+        table = self.__table(self.sprites)
+        size = self.frame_size
+        for i in range(self.sprites):
+            self.__setOffset(table, i)
+            self.__ptr('spr_'+str(i))
+            for v in (size, size, 0, size-1, size-1, 0, 0, 0, 0, 0, 0, size//2, size//2):
+                self.__int(v)
+            self.__int(self.frames)
+            for f in range(self.frames):
+                self.__int(packages[i*self.frames + f])
+            self.__int(1)
+            out.extend(bytes(((size + 7) // 8) * size))
+        self.__end(pos)
+
+        pos = self.__begin(b'STRG')
+        unique = sorted(set(s for p, s in self.__strings))
+        table = self.__table(len(unique))
+        located = {}
+        for i, s in enumerate(unique):
+            self.__setOffset(table, i)
+            encoded = s.encode('cp437')
+            self.__int(len(encoded))
+            located[s] = len(out)
+            out.extend(encoded + b'\x00')
+        self.__end(pos)
+        for p, s in self.__strings:
+            struct.pack_into('<i', out, p, located[s])
+        struct.pack_into('<i', out, 4, len(out) - 8)
+        return bytes(out)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.build())
+
+
+def timePhases(path, output_dir, convert=True):
+    # Same steps as gmk.load, timing every phase on its own
+    times = {}
+    with gmk.openStream(path) as fs:
+        d = gmk.Data()
+        start = time.perf_counter()
+        d.load(fs, gmk.LAZY_LOAD)
+        times['parse'] = time.perf_counter() - start
+        start = time.perf_counter()
+        d.saveResources(output_dir, fs, gmk.THREADS)
+        times['export'] = time.perf_counter() - start
+        if convert:
+            start = time.perf_counter()
+            d.convertResources(output_dir, fs)
+            times['convert'] = time.perf_counter() - start
+    return times
+
+def runBenchmark(scales, work_dir, convert=True, repeat=1):
+    results = []
+    for scale in scales:
+        synthetic = SyntheticData(sounds=50*scale, textures=max(1, scale), sprites=100*scale)
+        path = os.path.join(work_dir, 'data-x'+str(scale)+'.win')
+        synthetic.save(path)
+        size = os.path.getsize(path)
+        best = {}
+        for i in range(repeat):
+            output_dir = os.path.join(work_dir, 'out-x'+str(scale))
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            for phase, t in timePhases(path, output_dir, convert).items():
+                best[phase] = min(t, best.get(phase, t))
+        result = {'scale':scale, 'file_size':size, 'sprites':synthetic.sprites,
+                  'frames':synthetic.sprites*synthetic.frames, 'sounds':synthetic.sounds,
+                  'times':best, 'parse_mb_s':size / best['parse'] / 2**20}
+        log.info('scale x{0}: {1:.1f} MB, '.format(scale, size / 2**20) +
+                 ', '.join('{0} {1:.3f}s'.format(k, v) for k, v in best.items()))
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Times gmk.load phases against synthetic data.win files')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 50],
+                        help='size multipliers of the synthetic files, defaults to 1 10 50')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per scale, the best time of every phase is kept, defaults to 3')
+    parser.add_argument('--no-convert', action='store_true',
+                        help='skip the sprite conversion phase')
+    parser.add_argument('--mmap', action='store_true',
+                        help='use the memory mapped stream')
+    parser.add_argument('--lazy', action='store_true',
+                        help='decode the sections on demand')
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='number of threads used to write the resource files, defaults to 1')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='number of processes used to crop the sprites, defaults to 1')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also save the results into a JSON file, to compare between revisions')
+    parser.add_argument('--keep', metavar='DIR',
+                        help='generate the files into this dir and keep them, a temporary dir is used otherwise')
+    args = parser.parse_args()
+    # Only the benchmark results are interesting, not the progress of every run
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log.setLevel(logging.INFO)
+
+    gmk.USE_MMAP = args.mmap
+    gmk.LAZY_LOAD = args.lazy
+    gmk.THREADS = args.threads
+    gmk.JOBS = args.jobs
+    if args.keep is not None:
+        os.makedirs(args.keep, exist_ok=True)
+        results = runBenchmark(args.scales, args.keep, not args.no_convert, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = runBenchmark(args.scales, work_dir, not args.no_convert, args.repeat)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
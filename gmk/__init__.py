@@ -1,10 +1,26 @@
-from .util import FileReadStream, bytes_to_hex
+from .util import (FileReadStream, MmapReadStream, ExportScheduler, Manifest, Deduplicator, Profiler,
+                   ProfiledStream, ArchiveWriter, METADATA_WRITERS, bytes_to_hex, short_array, sha1_at,
+                   pack_array, unpack_array)
 import xml.etree.ElementTree as tree
-from xml.dom import minidom
 import os
+import io
 import logging
 import math
+import json
+import hashlib
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import chain
+from fnmatch import fnmatchcase
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
+try:
+    import numpy
+except ImportError: # Optional, only used to speed up the mask decoding
+    numpy = None
 
 class Data:
     
@@ -16,7 +32,9 @@ class Data:
         self.sections = []
         self.filenames = {} # A dictionary to map resources to their corresponding filenames
     
-    def load(self, fs):
+    def load(self, fs, lazy=False):
+        # In lazy mode only the chunk directory is read, every section decodes
+        # its entries the first time they are needed (see Section.materialize)
         self.sign = fs.readBytes(4)
         if self.sign != self.GMK_SIGN:
             logging.error('Unknown signature')
@@ -24,43 +42,213 @@ class Data:
         self.size = fs.readInt()
         cont = True
         while cont:
-            sec = Section.create(fs)
+            sec = Section.create(fs, lazy)
             if sec.tag == 'EOF':
                 cont = False
             else:
-                if sec.resources_tag is not None:
+                if sec.resources_tag is not None and sec.loaded:
                     self.filenames[sec.resources_tag] = sec.filenames
                 self.sections.append(sec)
         logging.info('### File processed ###')
+        
+    def dumpIndex(self):
+        sections = []
+        for sect in self.sections:
+            record = {'tag':sect.tag, 'size':sect.size, 'start_off':sect.start_off}
+            # Ignored or never materialized sections are parsed again when reused
+            if sect.loaded and not isinstance(sect, IgnoreSection):
+                record['state'] = sect.dumpIndex()
+            sections.append(record)
+        return {'size':self.size, 'sections':sections}
+    
+    def loadIndex(self, index, fs, lazy=False):
+        self.size = index['size']
+        for record in index['sections']:
+            sec = Section.build(record['tag'], record['size'], record['start_off'])
+            if isinstance(sec, IgnoreSection):
+                sec.loaded = True
+            elif 'state' in record:
+                sec.loadIndex(record['state'])
+                if isinstance(sec, SpriteSection): # The masks are still read from the data file
+                    sec.attach(fs)
+                sec.loaded = True
+            else:
+                fs.moveToOffset(sec.start_off)
+                if lazy:
+                    sec.defer(fs)
+                else:
+                    sec.load(fs)
+                    sec.loaded = True
+            if sec.resources_tag is not None and sec.loaded:
+                self.filenames[sec.resources_tag] = sec.filenames
+            self.sections.append(sec)
+        logging.info('### File index reused ###')
+        
+    def getSection(self, tag):
+        for sect in self.sections:
+            if sect.tag == tag:
+                sect.materialize()
+                return sect
+        return None
+    
+    def getFilenames(self, tag):
+        if tag not in self.filenames:
+            for sect in self.sections:
+                if sect.resources_tag == tag:
+                    sect.materialize()
+                    self.filenames[tag] = sect.filenames
+        return self.filenames.get(tag)
             
-    def saveResources(self, base_path, fs):
+    def saveResources(self, base_path, fs, threads=1, manifest=None):
         if not os.path.exists(base_path):
             os.mkdir(base_path)            
-        for sect in self.sections:
-            if sect.tag in self.filenames.keys():
-                sect.saveResources(base_path, filenames=self.filenames[sect.tag], data_file=fs)
-            else:
-                sect.saveResources(base_path, data_file=fs)
+        if Section.ONLY:
+            txtr = self.getSection('TXTR')
+            if isinstance(txtr, TextureSection):
+                txtr.required_pages = self.requiredTextures()
+        # Sections are parsed here, on this thread, the scheduler only runs the
+        # file writes, which use positional reads on the data file
+        with ExportScheduler(threads) as scheduler:
+            for sect in self.sections:
+                sect.materialize()
+                filenames = self.getFilenames(sect.tag)
+                # With several threads this only measures the time spent queuing the writes
+                with Section.profile('export', sect.tag):
+                    if filenames is not None:
+                        sect.saveResources(base_path, filenames=filenames, data_file=fs, scheduler=scheduler,
+                                           manifest=manifest)
+                    else:
+                        sect.saveResources(base_path, data_file=fs, scheduler=scheduler, manifest=manifest)
             
         logging.info('### Resources saved ###')
         
-    def convertResources(self, base_dir, fs):
+    def requiredTextures(self):
+        # Texture pages holding the frames of the sprites that pass the name filter
+        pages = set()
+        sprites = self.getSprites()
+        tpag = self.getSection('TPAG')
+        if sprites is None or not isinstance(tpag, TexturePackageSection):
+            return pages
+        for sprite in sprites:
+            if Section.wanted(sprite.name):
+                for off in sprite.subimages_offsets:
+                    entry = tpag.entry_at_offset(off)
+                    if entry is not None:
+                        pages.add(entry.textureId)
+        return pages
+        
+    def getSprites(self):
+        # Loaded sprite entries, so they don't have to be read back from the XML metadata
+        sect = self.getSection('SPRT')
+        if isinstance(sect, SpriteSection):
+            return sect.sprite_entries
+        return None
+        
+    def resources(self, fs, kinds=('audio', 'texture', 'sprite'), cache=None):
+        # Resource records of the given kinds, see iterResources. The sprite
+        # frames share cache, a TextureCache with the decoded texture pages.
+        if 'audio' in kinds:
+            audo = self.getSection('AUDO')
+            if isinstance(audo, AudioSection):
+                filenames = self.getFilenames('AUDO') or []
+                for i, off in enumerate(audo.audio_offsets):
+                    name = filenames[i] if i < len(filenames) else 'aud'+str(i)+'.wav'
+                    if Section.wanted(name, os.path.splitext(name)[0]):
+                        yield Resource('audio', name, off+4, fs.int_at(off), fs)
+        # Sections are only decoded for the kinds asked for, textures need
+        # TXTR, sprites need TXTR, TPAG and SPRT
+        if 'texture' not in kinds and 'sprite' not in kinds:
+            return
+        txtr = self.getSection('TXTR')
+        if not isinstance(txtr, TextureSection):
+            return
+        if 'texture' in kinds:
+            required = self.requiredTextures() if Section.ONLY else None
+            for i, entry in enumerate(txtr.texture_entries):
+                name = 'tex'+str(i)+'.png'
+                if required is None or i in required or Section.wanted(name, os.path.splitext(name)[0]):
+                    yield Resource('texture', name, entry.image_offset, entry.image_size, fs)
+        if 'sprite' not in kinds:
+            return
+        tpag = self.getSection('TPAG')
+        sprites = self.getSprites()
+        if sprites is not None and isinstance(tpag, TexturePackageSection):
+            cache = cache or TextureCache(TEXTURE_CACHE_SIZE)
+            for sprite in sprites:
+                if not Section.wanted(sprite.name):
+                    continue
+                for i, off in enumerate(sprite.subimages_offsets):
+                    entry = tpag.entry_at_offset(off)
+                    if entry is not None:
+                        box = (entry.originX, entry.originY, entry.originX+entry.width,
+                               entry.originY+entry.heigth)
+                        yield SpriteFrame(sprite.name, i, entry.textureId, box,
+                                          txtr.texture_entries[entry.textureId], fs, cache)
+        
+    def convertResources(self, base_dir, fs, manifest=None):
+        sprites = self.getSprites()
         for sect in self.sections:
-            sect.convertResources(base_dir, fs)
+            sect.materialize()
+            with Section.profile('convert', sect.tag):
+                sect.convertResources(base_dir, fs, sprites=sprites, manifest=manifest)
             
         logging.info('### Resources metadata processed ###')
                         
             
 class Section:    
     IGNORES = []
+    ONLY = [] # Name patterns of the resources to extract, empty to extract everything
+    PROFILER = None # Profiler collecting the per section statistics, None when not profiling
+    ARCHIVE = None # ArchiveWriter receiving the output files, None when writing plain files
     def __init__(self, tag, size, start_off):
         self.tag=tag
         self.size=size
         self.start_off=start_off
         self.resources_tag=None
+        self.loaded=False
+        self.deferred_fs=None
+    
+    @staticmethod
+    def profile(phase, section=None):
+        if Section.PROFILER is None:
+            return nullcontext()
+        return Section.PROFILER.measure(phase, section)
+    
+    @staticmethod
+    def wrote(n):
+        if Section.PROFILER is not None:
+            Section.PROFILER.wrote(n)
     
     @staticmethod
-    def create(fs):
+    def open(path):
+        # Output files go into the archive when there is one
+        if Section.ARCHIVE is not None:
+            return Section.ARCHIVE.open(path)
+        # It may be a hard link left by --dedup, writing through it would
+        # change the other files sharing it, so a new file is created instead
+        if os.path.lexists(path):
+            os.remove(path)
+        return open(path, 'wb')
+    
+    @staticmethod
+    def mkdir(path):
+        if Section.ARCHIVE is None and not os.path.exists(path):
+            os.mkdir(path)
+    
+    @staticmethod
+    def outputSize(path):
+        if Section.ARCHIVE is not None:
+            return Section.ARCHIVE.sizes.get(Section.ARCHIVE.name(path), 0)
+        return os.path.getsize(path)
+    
+    @staticmethod
+    def wanted(*names):
+        if not Section.ONLY:
+            return True
+        return any(fnmatchcase(name, pattern) for name in names for pattern in Section.ONLY)
+    
+    @staticmethod
+    def build(section_tag, section_size, start_off):
         _CLASSES = {
             'GEN8':IgnoreSection,
             'SOND':SoundSection,
@@ -69,26 +257,60 @@ class Section:
             'SPRT':SpriteSection,
             'TPAG':TexturePackageSection,
             }
+        if section_tag in Section.IGNORES:
+            return IgnoreSection(section_tag, section_size, start_off)
+        clazz = _CLASSES.get(section_tag, IgnoreSection)
+        return clazz(section_tag, section_size, start_off)
+    
+    @staticmethod
+    def create(fs, lazy=False):
         section_tag = fs.readTag()
         if section_tag == 'EOF':
             return IgnoreSection('EOF', 0, 0)
         section_size = fs.readInt()
-        if section_tag in Section.IGNORES:
-            ignore = IgnoreSection(section_tag, section_size, fs.currOffset())
-            ignore.load(fs)
-            return ignore
-        clazz = _CLASSES.get(section_tag, IgnoreSection)
-        ret = clazz(section_tag, section_size, fs.currOffset())
-        ret.load(fs)
+        ret = Section.build(section_tag, section_size, fs.currOffset())
+        if isinstance(ret, IgnoreSection):
+            ret.load(fs)
+            ret.loaded = True
+        elif lazy:
+            ret.defer(fs)
+        else:
+            with Section.profile('parse', section_tag):
+                ret.load(fs)
+            ret.loaded = True
         return ret
     
+    def defer(self, fs):
+        # Remember where the section lives and skip it, it will be loaded on demand
+        self.deferred_fs = fs
+        fs.skipBytes(self.size)
+    
+    def materialize(self):
+        if self.loaded or self.deferred_fs is None:
+            return
+        fs = self.deferred_fs
+        curoff = fs.currOffset() #Save the current offset
+        fs.moveToOffset(self.start_off)
+        with Section.profile('parse', self.tag):
+            self.load(fs)
+        fs.moveToOffset(curoff)
+        self.loaded = True
+        self.deferred_fs = None
+    
     def load(self, fs):
         raise Exception("Not implemented! Implement in subclasses")
     
-    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None):
+    def dumpIndex(self):
+        raise Exception("Not implemented! Implement in subclasses")
+    
+    def loadIndex(self, state):
+        raise Exception("Not implemented! Implement in subclasses")
+    
+    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         raise Exception("Not implemented! Implement in subclasses")
     
-    def convertResources(self, base_dir, data_file=None):
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         raise Exception("Not implemented! Implement in subclasses")
             
 class IgnoreSection(Section):
@@ -101,10 +323,11 @@ class IgnoreSection(Section):
         logging.info('Ignoring section '+self.tag)
         fs.skipBytes(self.size)
             
-    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None):
+    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('Ignoring resources for '+self.tag +" section")
         
-    def convertResources(self, base_dir, data_file=None):
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         logging.info('Ignoring metadata for '+self.tag+' section')
         
 class SoundSection(Section):
@@ -120,8 +343,7 @@ class SoundSection(Section):
         logging.info('### Processing Sound section ###')
         count = fs.readInt()
         logging.info('Reading {0} offset entries'.format(count))        
-        for i in range(count): #Read Offsets
-            self.soundoffsets.append(fs.readInt())
+        self.soundoffsets = fs.readInts(count) #Read Offsets
         logging.info('Loading {0} sound entries'.format(count))
         for off in self.soundoffsets: #Load Entries
             fs.moveToOffset(off)
@@ -141,11 +363,24 @@ class SoundSection(Section):
         fs.moveToOffset(self.start_off) #So we move to the beginning of the section...
         fs.skipBytes(self.size)#...and then skip to the next section.
         ### THIS IS VERY INEFFICIENT ### 
+        
+    def dumpIndex(self):
+        return {'offsets':pack_array(self.soundoffsets),
+                'entries':[entry.dumpIndex() for entry in self.soundentries]}
+    
+    def loadIndex(self, state):
+        self.soundoffsets = unpack_array(state['offsets'])
+        for data in state['entries']:
+            entry = SoundEntry()
+            entry.loadIndex(data)
+            self.filenames.append(entry.filename)
+            self.soundentries.append(entry)
             
-    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None):
+    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('no resources for Sound section only metadata')
     
-    def convertResources(self, base_dir, data_file=None):
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         logging.info('metadata conversion not applicable to '+self.tag+' section')
             
             
@@ -172,6 +407,20 @@ class SoundEntry:
         self.pan = fs.readBytes(8)
         self.preload = fs.readBytes(4)  
         self.audo_index = fs.readInt()
+        
+    def dumpIndex(self):
+        return [self.name, bytes(self.type).hex(), self.ext, self.filename, bytes(self.effects).hex(),
+                bytes(self.volume).hex(), bytes(self.pan).hex(), bytes(self.preload).hex(),
+                self.audo_index]
+    
+    def loadIndex(self, data):
+        (self.name, typ, self.ext, self.filename, effects, volume, pan, preload,
+         self.audo_index) = data
+        self.type = bytes.fromhex(typ)
+        self.effects = bytes.fromhex(effects)
+        self.volume = bytes.fromhex(volume)
+        self.pan = bytes.fromhex(pan)
+        self.preload = bytes.fromhex(preload)
     
         
     def __repr__(self):
@@ -194,38 +443,44 @@ class AudioSection(Section):
         logging.info('### Processing Audio section ###') 
         count = fs.readInt()
         logging.info('Reading {0} offset entries'.format(count))
-        for i in range(count):
-            self.audio_offsets.append(fs.readInt())
+        self.audio_offsets = fs.readInts(count)
         # We will not load all the audio data on memory, so we will skip that data
         fs.moveToOffset(self.start_off)
         fs.skipBytes(self.size)
         
+    def dumpIndex(self):
+        return {'offsets':pack_array(self.audio_offsets)}
+    
+    def loadIndex(self, state):
+        self.audio_offsets = unpack_array(state['offsets'])
             
-    def saveResources(self, base_dir, subdir='audio', filenames=[], data_file=None):
+    def saveResources(self, base_dir, subdir='audio', filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('### Saving Resources for Audio section ###')
         if data_file is None:
             raise Exception('Cannot locate data file')
                 
         audio_dir = os.path.join(base_dir, subdir)
-        if not os.path.exists(audio_dir):
-            os.mkdir(audio_dir)
+        Section.mkdir(audio_dir)
         
-        if len(filenames) == 0:
+        if not filenames: # A fresh list, so the names don't leak into later calls
             base_aud = 'aud'
-            for i in range(len(self.audio_offsets)):
-                filenames.append(base_aud+str(i)+'.wav')   
+            filenames = [base_aud+str(i)+'.wav' for i in range(len(self.audio_offsets))]
                 
+        scheduler = scheduler or ExportScheduler()
+        dedup = Deduplicator() if DEDUP else None
+        count = 0
         for name, off in zip(filenames, self.audio_offsets):
+            if not Section.wanted(name, os.path.splitext(name)[0]):
+                continue
             fname = os.path.join(audio_dir, name)
-            data_file.moveToOffset(off)
-            audio_len = data_file.readInt()
-            audio_data = data_file.readBytes(audio_len)# Now is when we load the audio data
-            with open(fname, 'wb') as f:
-                f.write(audio_data) # And we store it
+            # Now is when we copy the audio data, it's preceded by its length
+            scheduler.submit(saveBlob, data_file, fname, off+4, data_file.int_at(off), manifest, dedup)
+            count += 1
                 
-        logging.info('Saved {0} audio files'.format(len(self.audio_offsets)))
+        logging.info('Queued {0} audio files'.format(count))
     
-    def convertResources(self, base_dir, data_file=None):
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         logging.info('metadata conversion not applicable to '+self.tag+' section')
     
 
@@ -234,13 +489,13 @@ class TextureSection(Section):
         Section.__init__(self, *args)
         self.texture_offsets = []
         self.texture_entries = []
+        self.required_pages = None # Pages needed by the filtered sprites, None when not filtering
     
     def load(self, fs):
         logging.info('### Processing Texture Section ###')
         count = fs.readInt()
         logging.info('Reading {0} entry offsets'.format(count))
-        for i in range(count):
-            self.texture_offsets.append(fs.readInt())  
+        self.texture_offsets = fs.readInts(count)
         logging.info('Loading {0} entries'.format(count))
         
         for off in self.texture_offsets:
@@ -259,32 +514,46 @@ class TextureSection(Section):
         if last_entry.image_size == -1:            
             last_entry.image_size = last_off - last_entry.image_offset            
         fs.moveToOffset(last_off)
+        
+    def dumpIndex(self):
+        return {'offsets':pack_array(self.texture_offsets),
+                'entries':[[e.magic, e.image_offset, e.image_size] for e in self.texture_entries]}
+    
+    def loadIndex(self, state):
+        self.texture_offsets = unpack_array(state['offsets'])
+        for data in state['entries']:
+            entry = TextureEntry()
+            entry.magic, entry.image_offset, entry.image_size = data
+            self.texture_entries.append(entry)
             
-    def saveResources(self, base_dir, subdir='textures', filenames=[], data_file=None):
+    def saveResources(self, base_dir, subdir='textures', filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('### Saving Resources for Texture section ###')
         if data_file is None:
             raise Exception('Cannot locate data file')
         
         tex_dir = os.path.join(base_dir, subdir)
-        if not os.path.exists(tex_dir):
-            os.mkdir(tex_dir)
+        Section.mkdir(tex_dir)
         
-        if len(filenames) == 0:
+        if not filenames:
             base_tex = 'tex'
-            for i in range(len(self.texture_offsets)):
-                filenames.append(base_tex+str(i)+'.png')
+            filenames = [base_tex+str(i)+'.png' for i in range(len(self.texture_offsets))]
         
-        for name, entry in zip(filenames, self.texture_entries):
+        scheduler = scheduler or ExportScheduler()
+        dedup = Deduplicator() if DEDUP else None
+        count = 0
+        for i, (name, entry) in enumerate(zip(filenames, self.texture_entries)):
+            if (self.required_pages is not None and i not in self.required_pages and
+                    not Section.wanted(name, os.path.splitext(name)[0])):
+                continue
             fname = os.path.join(tex_dir, name)
-            data_file.moveToOffset(entry.image_offset)
-            tex_len = entry.image_size
-            tex_data = data_file.readBytes(tex_len)
-            with open(fname, 'wb') as f:
-                f.write(tex_data) 
+            scheduler.submit(saveBlob, data_file, fname, entry.image_offset, entry.image_size, manifest,
+                             dedup)
+            count += 1
                 
-        logging.info('Saved {0} texture files'.format(len(self.texture_entries)))
+        logging.info('Queued {0} texture files'.format(count))
     
-    def convertResources(self, base_dir, data_file=None):
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         logging.info('metadata conversion not applicable to '+self.tag+' section')
         
 
@@ -326,8 +595,7 @@ class SpriteSection(Section):
         logging.info('### Processing Sprite Section ###')
         count = fs.readInt()
         logging.info('Reading {0} offset entries'.format(count))
-        for i in range(count):
-            self.sprite_offsets.append(fs.readInt())
+        self.sprite_offsets = fs.readInts(count)
         logging.info('Loading {0} entries'.format(count))
         for off in self.sprite_offsets:
             fs.moveToOffset(off)
@@ -337,39 +605,101 @@ class SpriteSection(Section):
             
         fs.moveToOffset(self.start_off)
         fs.skipBytes(self.size)
+        
+    def dumpIndex(self):
+        return {'offsets':pack_array(self.sprite_offsets),
+                'entries':[entry.dumpIndex() for entry in self.sprite_entries]}
+    
+    def loadIndex(self, state):
+        self.sprite_offsets = unpack_array(state['offsets'])
+        for data in state['entries']:
+            entry = SpriteEntry()
+            entry.loadIndex(data)
+            self.sprite_entries.append(entry)
             
-    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None):
+    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('### Saving Resources for Sprite section ###')
-        root = tree.Element('sprites')
+        scheduler = scheduler or ExportScheduler()
+        scheduler.submit(self.writeMetadata, base_dir)
+        if MASK_FORMAT is not None:
+            if data_file is None:
+                raise Exception('Cannot locate data file')
+            scheduler.submit(self.writeMasks, base_dir, data_file)
+        
+    def wantedEntries(self):
+        return [entry for entry in self.sprite_entries if Section.wanted(entry.name)]
+        
+    def attach(self, fs):
+        # Entries restored from the index cache read their masks from fs
         for entry in self.sprite_entries:
-            attrib={'name':entry.name,
-                    'width':str(entry.width),
-                    'height':str(entry.height),
-                    'leftPad':str(entry.leftPad),
-                    'rightPad':str(entry.rightPad),
-                    'bottomPad':str(entry.bottomPad),
-                    'originX':str(entry.originX),
-                    'originY':str(entry.originY),
-                    'collision_mask':str(entry.collision_mask),}
-            e = tree.SubElement(root, 'sprite', attrib)
-            # e.text = 'Mask = '+bytes_to_hex(entry.mask)
-            subimages = tree.SubElement(e, 'subimages')
-            for off in entry.subimages_offsets:
-                tree.SubElement(subimages, 'offset', {'value':str(off)})
-                
-        ugly = tree.tostring(root, 'utf-8')
-        reparsed = minidom.parseString(ugly)
-        pretty = reparsed.toprettyxml(indent='  ', newl=os.linesep, encoding='utf-8')
-        xml = os.path.join(base_dir, 'sprites-metadata.xml')
-        with open(xml, 'wb') as f:
-            f.write(pretty)
-        logging.info('Saved {0} sprite metadata entries into an XML'.format(len(self.sprite_entries)))
-        
-    def convertResources(self, base_dir, data_file=None):
+            entry.fs = fs
+        
+    def maskBitmaps(self, fs):
+        # Decodes the collision masks of the wanted sprites in bulk, MASK_BATCH_SIZE
+        # bytes of raw masks at a time, yields (entry, bitmap) pairs
+        batch = []
+        size = 0
+        for entry in self.wantedEntries():
+            batch.append(entry)
+            size += entry.maskSize()
+            if size >= MASK_BATCH_SIZE:
+                yield from zip(batch, decodeMasks([e.readMask(fs) for e in batch],
+                                                  [(e.width, e.height) for e in batch]))
+                batch = []
+                size = 0
+        if batch:
+            yield from zip(batch, decodeMasks([e.readMask(fs) for e in batch], [(e.width, e.height) for e in batch]))
+        
+    def writeMasks(self, base_dir, fs):
+        entries = self.wantedEntries()
+        if MASK_FORMAT == 'png':
+            mask_dir = os.path.join(base_dir, 'masks')
+            Section.mkdir(mask_dir)
+            for entry, bitmap in self.maskBitmaps(fs):
+                if entry.width > 0 and entry.height > 0:
+                    img = Image.frombytes('1', (entry.width, entry.height), packMask(bitmap, entry.width))
+                    with Section.open(os.path.join(mask_dir, entry.name+'.png')) as f:
+                        img.save(f, 'PNG')
+            path = mask_dir
+        else:
+            # For every sprite: name length, name, width, height (int32) and the
+            # mask, 1 bit per pixel with its rows padded to whole bytes
+            path = os.path.join(base_dir, 'sprites-masks.bin')
+            with Section.open(path) as f:
+                for entry, bitmap in self.maskBitmaps(fs):
+                    name = entry.name.encode('utf-8')
+                    f.write(struct.pack('<i', len(name)) + name + struct.pack('<ii', entry.width, entry.height))
+                    f.write(packMask(bitmap, entry.width))
+        if Section.PROFILER is not None:
+            Section.wrote(sum(entry.maskSize() for entry in entries))
+        logging.info('Saved {0} sprite collision masks into {1}'.format(len(entries), path))
+        
+    def writeMetadata(self, base_dir):
+        writer = METADATA_WRITERS[METADATA_FORMAT]
+        with writer(os.path.join(base_dir, 'sprites-metadata'), 'sprites', Section.open) as out:
+            for entry in self.wantedEntries():
+                attrib={'name':entry.name,
+                        'width':entry.width,
+                        'height':entry.height,
+                        'leftPad':entry.leftPad,
+                        'rightPad':entry.rightPad,
+                        'bottomPad':entry.bottomPad,
+                        'originX':entry.originX,
+                        'originY':entry.originY,
+                        'collision_mask':entry.collision_mask,}
+                out.writeEntry('sprite', attrib, {'subimages':('offset', 'value', entry.subimages_offsets)})
+        Section.wrote(Section.outputSize(out.path))
+        logging.info('Saved {0} sprite metadata entries into {1}'.format(out.count, out.path))
+        
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
         logging.info('metadata conversion not applicable to '+self.tag+' section')
         
 
 class SpriteEntry:
+    __slots__ = ('name', 'width', 'height', 'leftPad', 'rightPad', 'bottomPad', 'topPad', 'originX',
+                 'originY', 'subimages_offsets', 'collision_mask', 'mask_offset', 'fs')
+    
     def __init__(self):
         self.name = ''
         self.width = 0
@@ -382,25 +712,48 @@ class SpriteEntry:
         self.originY = 0
         self.subimages_offsets = []
         self.collision_mask = 0
-        self.mask = b''
+        self.mask_offset = 0 # The mask is only read when it's needed
+        self.fs = None # Data file the mask is read from
     
     def load(self, fs):
-        self.name = fs.readOffsetStr()
-        self.width = fs.readInt()
-        self.height = fs.readInt()
-        self.leftPad = fs.readInt()
-        self.rightPad = fs.readInt()
-        self.bottomPad = fs.readInt()
-        self.topPad = fs.readInt()
-        fs.skipBytes(5*4) #Unknown bytes
-        self.originX = fs.readInt()
-        self.originY = fs.readInt()
-        count = fs.readInt() #Number of sub-images
-        for i in range(count):
-            self.subimages_offsets.append(fs.readInt())
+        # The fixed part of the entry is decoded in one go
+        header = fs.readInts(15)
+        self.name = fs.str_at(header[0])
+        (self.width, self.height, self.leftPad, self.rightPad, self.bottomPad,
+         self.topPad) = header[1:7]
+        # header[7:12] are unknown
+        self.originX, self.originY = header[12:14]
+        count = header[14] #Number of sub-images
+        self.subimages_offsets = fs.readInts(count)
         self.collision_mask = fs.readInt()
-        num_bytes = math.ceil(self.width / 8) * self.height
-        self.mask = fs.readBytes(num_bytes)
+        self.mask_offset = fs.currOffset()
+        self.fs = fs
+        fs.skipBytes(self.maskSize())
+        
+    @property
+    def mask(self):
+        # Raw mask bytes, read from the data file on every access while it's open
+        return bytes(self.readMask(self.fs))
+        
+    def maskSize(self):
+        return math.ceil(self.width / 8) * self.height
+    
+    def readMask(self, fs):
+        return fs.read_at(self.mask_offset, self.maskSize())
+    
+    def maskBitmap(self, fs):
+        return decodeMask(self.readMask(fs), self.width, self.height)
+        
+    def dumpIndex(self):
+        return [self.name, self.width, self.height, self.leftPad, self.rightPad, self.bottomPad,
+                self.topPad, self.originX, self.originY, pack_array(self.subimages_offsets),
+                self.collision_mask, self.mask_offset]
+    
+    def loadIndex(self, data):
+        (self.name, self.width, self.height, self.leftPad, self.rightPad, self.bottomPad,
+         self.topPad, self.originX, self.originY, offsets, self.collision_mask,
+         self.mask_offset) = data
+        self.subimages_offsets = unpack_array(offsets)
             
     def __repr__(self):
         return str.format('<SpriteEntry name={name:}, width={width:d}, height={height:d}, '+
@@ -413,109 +766,465 @@ class TexturePackageSection(Section):
     def __init__(self, *args):
         Section.__init__(self, *args)
         self.package_offsets = []
-        self.package_entries = []        
+        self.package_entries = TexturePackageTable()
+        self.package_index = None
         
     def load(self, fs):
         logging.info('### Processing Texture Package Section ###')
         count = fs.readInt()
         logging.info('Reading {0} entry offsets'.format(count))
-        for i in range(count):
-            self.package_offsets.append(fs.readInt())
+        self.package_offsets = fs.readInts(count)
         logging.info('Loading {0} entries'.format(count))
-        for off in self.package_offsets:
-            fs.moveToOffset(off)
-            entry = TexturePackageEntry()
-            entry.load(fs)
-            self.package_entries.append(entry)
+        self.package_entries = TexturePackageTable.read(fs, self.package_offsets)
             
         fs.moveToOffset(self.start_off)
         fs.skipBytes(self.size)
+        
+    def dumpIndex(self):
+        # Saved column by column, the same way the table keeps them
+        return {'offsets':pack_array(self.package_offsets),
+                'columns':[pack_array(col, 'h') for col in self.package_entries.columns]}
+    
+    def loadIndex(self, state):
+        self.package_offsets = unpack_array(state['offsets'])
+        self.package_entries = TexturePackageTable([unpack_array(col, 'h') for col in state['columns']])
             
-    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None):
+    def saveResources(self, base_dir, subdir=None, filenames=None, data_file=None, scheduler=None,
+                      manifest=None):
         logging.info('### Saving Resources for Texture Package section ###')
-        root = tree.Element('texture-packages')
-        for entry in self.package_entries:
-            attrib = {
-                'originX':str(entry.originX),
-                'originY':str(entry.originY),
-                'width':str(entry.width),
-                'heigth':str(entry.heigth),
-                'subframeX':str(entry.subframeX),
-                'subframeY':str(entry.subframeY),
-                'subframeWidth':str(entry.subframeWidth),
-                'subframeHeight':str(entry.subframeHeight),
-                'canvasWidth':str(entry.canvasWidth),
-                'canvasHeight':str(entry.canvasHeight),
-                'textureId':str(entry.textureId),
-                }
-            tree.SubElement(root, 'package', attrib)
-            
-        ugly = tree.tostring(root, 'utf-8')
-        reparsed = minidom.parseString(ugly)
-        pretty = reparsed.toprettyxml(indent='  ', newl=os.linesep, encoding='utf-8')
-        xml = os.path.join(base_dir, 'texture-metadata.xml')
-        with open(xml, 'wb') as f:
-            f.write(pretty)
+        (scheduler or ExportScheduler()).submit(self.writeMetadata, base_dir)
+        
+    def writeMetadata(self, base_dir):
+        writer = METADATA_WRITERS[METADATA_FORMAT]
+        with writer(os.path.join(base_dir, 'texture-metadata'), 'texture-packages', Section.open) as out:
+            for entry in self.package_entries:
+                attrib = {
+                    'originX':entry.originX,
+                    'originY':entry.originY,
+                    'width':entry.width,
+                    'heigth':entry.heigth,
+                    'subframeX':entry.subframeX,
+                    'subframeY':entry.subframeY,
+                    'subframeWidth':entry.subframeWidth,
+                    'subframeHeight':entry.subframeHeight,
+                    'canvasWidth':entry.canvasWidth,
+                    'canvasHeight':entry.canvasHeight,
+                    'textureId':entry.textureId,
+                    }
+                out.writeEntry('package', attrib)
             
-        logging.info('Saved {0} texture metadata entries into an XML file'.format(len(self.package_entries)))
+        Section.wrote(Section.outputSize(out.path))
+        logging.info('Saved {0} texture metadata entries into {1}'.format(out.count, out.path))
         
-    def convertResources(self, base_dir, data_file=None):
-        sprites_file = os.path.join(base_dir, 'sprites-metadata.xml') 
-        sprite_entries = tree.parse(sprites_file).iter('sprite')
+    def convertResources(self, base_dir, data_file=None, sprites=None, manifest=None):
+        if sprites is not None:
+            sprite_entries = [(entry.name, entry.subimages_offsets) for entry in sprites]
+        else: # Sprites section not loaded, fall back to the metadata from a previous run
+            sprites_file = os.path.join(base_dir, 'sprites-metadata.jsonl')
+            sprite_entries = []
+            if METADATA_FORMAT == 'jsonl':
+                with open(sprites_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        e = json.loads(line)
+                        sprite_entries.append((e['name'], e['subimages']))
+            else:
+                sprites_file = os.path.join(base_dir, 'sprites-metadata.xml') 
+                for e in tree.parse(sprites_file).iter('sprite'):
+                    offsets = e.find('subimages').iter('offset')
+                    sprite_entries.append((e.attrib['name'], [int(eoff.attrib['value']) for eoff in offsets]))
         texture_dir = os.path.join(base_dir, 'textures')
         sprite_dir = os.path.join(base_dir, 'sprites')
-        if not os.path.exists(sprite_dir):
-            os.mkdir(sprite_dir)
+        Section.mkdir(sprite_dir)
         sprite_count = 0
         logging.info('### Converting Sprite metadata ###')
-        for e in sprite_entries:
-            name = e.attrib['name']
-            offsets = e.find('subimages').iter('offset')
-            for i, eoff in enumerate(offsets):
-                val = int(eoff.attrib['value'])                
-                for off, entry in zip(self.package_offsets, self.package_entries):
-                    if off == val: # Entry found
-                        tex = os.path.join(texture_dir, 'tex'+str(entry.textureId)+'.png')
-                        img = Image.open(tex)
-                        cropped = img.crop((entry.originX, entry.originY, entry.originX+entry.width,
-                                            entry.originY+entry.heigth))
-                        path = os.path.join(sprite_dir, name+'_'+str(i)+'.png')
-                        cropped.save(path, 'PNG')
-                        sprite_count += 1
-                        break
+        if SHEET_LAYOUT is not None:
+            self.convertSheets(sprite_entries, base_dir, texture_dir, sprite_dir, manifest)
+            return
+        # Frames are processed grouped by texture page so every page is decoded only once
+        crops = self.collectCrops(sprite_entries, sprite_dir)
+        if manifest is not None:
+            crops = self.changedCrops(crops, texture_dir, manifest)
+        if JOBS > 1:
+            sprite_count = self.convertParallel(crops, texture_dir)
+        else:
+            cache = TextureCache(TEXTURE_CACHE_SIZE)
+            dedup = Deduplicator() if DEDUP else None
+            for tid, jobs in sorted(crops.items()):
+                tex = os.path.join(texture_dir, 'tex'+str(tid)+'.png')
+                # In an archive the pages are read back from the data file
+                img = cache.get(tex, Section.ARCHIVE.source(tex) if Section.ARCHIVE is not None else None)
+                sprite_count += cropImage(img, jobs, dedup)
                     
         logging.info('Saved {0} sprites'.format(sprite_count))                                 
+        if Section.PROFILER is not None:
+            Section.wrote(sum(Section.outputSize(path) for jobs in crops.values() for box, path in jobs))
+        if manifest is not None:
+            for tid, jobs in crops.items():
+                page = manifest.digest(os.path.join(texture_dir, 'tex'+str(tid)+'.png'))
+                for box, path in jobs:
+                    manifest.update(path, page=page, box=list(box))
+        
+    def convertSheets(self, sprite_entries, base_dir, texture_dir, sprite_dir, manifest):
+        # Every sprite becomes a single image with its frames laid out as a strip
+        # or a grid, the frame rectangles are saved into sprite-sheets.json
+        sheets = self.collectSheets(sprite_entries, sprite_dir)
+        index = {}
+        for name, path, frames in sheets:
+            size, positions = sheetLayout(frames, SHEET_LAYOUT)
+            index[name] = {'image':os.path.relpath(path, base_dir).replace(os.sep, '/'),
+                           'width':size[0], 'height':size[1],
+                           'frames':[{'x':x, 'y':y, 'width':box[2]-box[0], 'height':box[3]-box[1]}
+                                     for (tid, box), (x, y) in zip(frames, positions)]}
+        jobs = [(path, frames) for name, path, frames in sheets]
+        if manifest is not None:
+            pages = {}
+            def state(frames):
+                for tid, box in frames:
+                    if tid not in pages:
+                        pages[tid] = manifest.digest(os.path.join(texture_dir, 'tex'+str(tid)+'.png'))
+                return {'pages':[pages[tid] for tid, box in frames], 'boxes':[list(box) for tid, box in frames],
+                        'layout':SHEET_LAYOUT}
+            changed = [(path, frames) for path, frames in jobs if not manifest.unchanged(path, **state(frames))]
+            logging.info('Skipping {0} unchanged sprite sheets'.format(len(jobs) - len(changed)))
+            jobs = changed
+        if JOBS > 1:
+            logging.info('Assembling {0} sprite sheets with {1} processes'.format(len(jobs), JOBS))
+            with ProcessPoolExecutor(max_workers=JOBS) as pool:
+                futures = [pool.submit(buildSheets, jobs[i::JOBS], texture_dir, SHEET_LAYOUT,
+                                       TEXTURE_CACHE_SIZE // JOBS, DEDUP) for i in range(JOBS)]
+                for f in futures:
+                    f.result()
+        else:
+            source = None
+            if Section.ARCHIVE is not None: # The pages are read back from the data file
+                source = Section.ARCHIVE.source
+            buildSheets(jobs, texture_dir, SHEET_LAYOUT, TEXTURE_CACHE_SIZE, DEDUP, source)
+        path = os.path.join(base_dir, 'sprite-sheets.json')
+        with Section.open(path) as f:
+            f.write(json.dumps(index, indent=2).encode('utf-8'))
+        logging.info('Saved {0} sprite sheets, frame rectangles saved into {1}'.format(len(jobs), path))
+        if Section.PROFILER is not None:
+            Section.wrote(sum(Section.outputSize(p) for p, frames in jobs) + Section.outputSize(path))
+        if manifest is not None:
+            for p, frames in jobs:
+                manifest.update(p, **state(frames))
+        
+    def collectSheets(self, sprite_entries, sprite_dir):
+        # Returns a (name, path, frames) tuple for every sprite, frames being the
+        # (textureId, box) of its sub-images in order
+        sheets = []
+        for name, offsets in sprite_entries:
+            if not Section.wanted(name):
+                continue
+            frames = []
+            for off in offsets:
+                entry = self.entry_at_offset(off)
+                if entry is not None:
+                    frames.append((entry.textureId, (entry.originX, entry.originY, entry.originX+entry.width,
+                                                     entry.originY+entry.heigth)))
+            if frames:
+                sheets.append((name, os.path.join(sprite_dir, name+'.png'), frames))
+        # Sprites on the same texture page end up next to each other, so every
+        # page is mostly decoded once even when it doesn't fit in the cache
+        sheets.sort(key=lambda sheet: min(tid for tid, box in sheet[2]))
+        return sheets
+        
+    def changedCrops(self, crops, texture_dir, manifest):
+        # Drops the crops whose texture page and rectangle didn't change since the last run
+        changed = {}
+        skipped = 0
+        for tid, jobs in crops.items():
+            page = manifest.digest(os.path.join(texture_dir, 'tex'+str(tid)+'.png'))
+            for box, path in jobs:
+                if manifest.unchanged(path, page=page, box=list(box)):
+                    skipped += 1
+                else:
+                    changed.setdefault(tid, []).append((box, path))
+        logging.info('Skipping {0} unchanged sprites'.format(skipped))
+        return changed
+        
+    def entry_at_offset(self, off):
+        # Resolves a TPAG pointer, the lookup table is built on first use
+        if self.package_index is None:
+            self.package_index = {o:i for i, o in enumerate(self.package_offsets)}
+        i = self.package_index.get(off)
+        return self.package_entries[i] if i is not None else None
+    
+    def collectCrops(self, sprite_entries, sprite_dir):
+        # Takes (name, subimage offsets) pairs and returns a dictionary mapping
+        # every textureId to a list of (box, path) tuples
+        crops = {}
+        for name, offsets in sprite_entries:
+            if not Section.wanted(name):
+                continue
+            for i, off in enumerate(offsets):
+                entry = self.entry_at_offset(off)
+                if entry is not None:
+                    box = (entry.originX, entry.originY, entry.originX+entry.width,
+                           entry.originY+entry.heigth)
+                    path = os.path.join(sprite_dir, name+'_'+str(i)+'.png')
+                    crops.setdefault(entry.textureId, []).append((box, path))
+        return crops
+    
+    def convertParallel(self, crops, texture_dir):
+        logging.info('Cropping sprites from {0} textures with {1} processes'.format(len(crops), JOBS))
+        # The crops of a page are split in chunks so a game with a single atlas
+        # still uses every process, each of them decoding the pages it touches
+        chunk = max(1, math.ceil(sum(len(jobs) for jobs in crops.values()) / JOBS))
+        with ProcessPoolExecutor(max_workers=JOBS) as pool:
+            futures = [pool.submit(cropTexture, os.path.join(texture_dir, 'tex'+str(tid)+'.png'),
+                                   jobs[i:i+chunk], DEDUP)
+                       for tid, jobs in sorted(crops.items()) for i in range(0, len(jobs), chunk)]
+            return sum(f.result() for f in futures)
                 
         
+class TexturePackageTable:
+    # All the TPAG entries stored column by column, one array('h') per field,
+    # the entries are handed out as TexturePackageEntry views over a row
+    FIELDS = 11
+    
+    def __init__(self, columns=None):
+        self.columns = columns if columns is not None else [array('h') for i in range(self.FIELDS)]
+        
+    @staticmethod
+    def read(fs, offsets):
+        table = TexturePackageTable()
+        if len(offsets) == 0:
+            return table
+        row = 2*table.FIELDS
+        start = offsets[0]
+        if all(off == start + i*row for i, off in enumerate(offsets)):
+            # Entries are packed one after another, so the columns are just strided slices
+            values = short_array(fs.read_at(start, row*len(offsets)))
+            table.columns = [values[i::table.FIELDS] for i in range(table.FIELDS)]
+        else:
+            for off in offsets:
+                for col, v in zip(table.columns, short_array(fs.read_at(off, row))):
+                    col.append(v)
+        return table
+    
+    def __len__(self):
+        return len(self.columns[0])
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('texture package entry out of range')
+        return TexturePackageEntry(self, i)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TexturePackageEntry(self, i)
+    
+    def append(self, entry):
+        for col, v in zip(self.columns, entry.dumpIndex()):
+            col.append(v)
+            
+            
+def _column(i):
+    def getter(self):
+        return self.table.columns[i][self.row]
+    def setter(self, value):
+        self.table.columns[i][self.row] = value
+    return property(getter, setter)
+        
 class TexturePackageEntry:
-    def __init__(self):
-        self.originX = 0
-        self.originY = 0
-        self.width = 0
-        self.heigth = 0
-        self.subframeX = 0
-        self.subframeY = 0
-        self.subframeWidth = 0
-        self.subframeHeight = 0
-        self.canvasWidth = 0
-        self.canvasHeight = 0
-        self.textureId = 0
+    __slots__ = ('table', 'row')
+    
+    originX = _column(0)
+    originY = _column(1)
+    width = _column(2)
+    heigth = _column(3)
+    subframeX = _column(4)
+    subframeY = _column(5)
+    subframeWidth = _column(6)
+    subframeHeight = _column(7)
+    canvasWidth = _column(8)
+    canvasHeight = _column(9)
+    textureId = _column(10)
+    
+    def __init__(self, table=None, row=0):
+        if table is None: # Standalone entry, backed by a table of its own
+            table = TexturePackageTable([array('h', [0]) for i in range(TexturePackageTable.FIELDS)])
+        self.table = table
+        self.row = row
     
     def load(self, fs):
-        self.originX = fs.readShort()
-        self.originY = fs.readShort()
-        self.width = fs.readShort()
-        self.heigth = fs.readShort()
-        self.subframeX = fs.readShort()
-        self.subframeY = fs.readShort()
-        self.subframeWidth = fs.readShort()
-        self.subframeHeight = fs.readShort()
-        self.canvasWidth = fs.readShort()
-        self.canvasHeight = fs.readShort()
-        self.textureId = fs.readShort()
+        self.loadIndex(short_array(fs.readBytes(2*TexturePackageTable.FIELDS)))
+        
+    def dumpIndex(self):
+        return [col[self.row] for col in self.table.columns]
+    
+    def loadIndex(self, data):
+        for col, v in zip(self.table.columns, data):
+            col[self.row] = v
             
 
 CONVERT_RESOURCES = False #Flag indicating whether the resource metadata should be processed
+METADATA_FORMAT = 'xml' #Format of the metadata files, either xml or jsonl
+THREADS = 1 #Number of threads used to write the resource files
+MASK_FORMAT = None #Format of the exported collision masks, either png, bin or None to skip them
+JOBS = 1 #Number of processes used to crop the sprites when converting the metadata
+TEXTURE_CACHE_SIZE = 256 * 1024 * 1024 #Memory budget in bytes for the decoded texture pages
+USE_MMAP = False #Flag indicating whether the data file should be memory mapped instead of read
+LAZY_LOAD = False #Flag indicating whether sections should only be decoded when they are needed
+USE_INDEX_CACHE = False #Flag indicating whether the parsed index should be cached in the output dir
+INDEX_FILE = 'data-index.json'
+INCREMENTAL = False #Flag indicating whether unchanged output files should be left alone
+DEDUP = False #Flag indicating whether files with the same content should be hard linked
+PROFILE = False #Flag indicating whether a profile.json report should be saved in the output dir
+ARCHIVE = None #Path of the zip or tar archive receiving the output files, None to write plain files
+SHEET_LAYOUT = None #Either strip or grid to save every sprite as a single sheet, None for a file per frame
+MASK_BATCH_SIZE = 1024 * 1024 #Bytes of raw collision masks decoded at once
+INDEX_VERSION = 3
+INDEX_SAMPLE_SIZE = 64 * 1024 #Bytes hashed at each end of the file to tell it apart in the index cache
+        
+_MASK_BITS = [tuple(bool(b & (0x80 >> i)) for i in range(8)) for b in range(256)]
+
+def decodeMask(mask, width, height):
+    # Masks are 1 bit per pixel, MSB first, with every row padded to a whole byte.
+    # Returns a boolean numpy array when available, a list of rows otherwise.
+    stride = math.ceil(width / 8)
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(mask, numpy.uint8).reshape(height, stride), axis=1)
+        return bits[:, :width].astype(bool)
+    rows = []
+    for y in range(height):
+        row = mask[y*stride:(y+1)*stride]
+        rows.append(list(chain.from_iterable(_MASK_BITS[b] for b in row))[:width])
+    return rows
+        
+def decodeMasks(masks, sizes):
+    # Decodes many masks in a single pass over their joined bytes, sizes holds
+    # the (width, height) of every mask. Returns one bitmap per mask, like decodeMask.
+    buf = b''.join(bytes(m) for m in masks)
+    bitmaps = []
+    pos = 0
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(buf, numpy.uint8)).astype(bool)
+        for width, height in sizes:
+            stride = 8*math.ceil(width / 8)
+            bitmaps.append(bits[pos:pos+stride*height].reshape(height, stride)[:, :width])
+            pos += stride*height
+        return bitmaps
+    bits = list(chain.from_iterable(_MASK_BITS[b] for b in buf))
+    for width, height in sizes:
+        stride = 8*math.ceil(width / 8)
+        bitmaps.append([bits[pos+y*stride:pos+y*stride+width] for y in range(height)])
+        pos += stride*height
+    return bitmaps
+        
+def packMask(bitmap, width):
+    # Back to 1 bit per pixel, MSB first, with every row padded to a whole byte
+    if numpy is not None and isinstance(bitmap, numpy.ndarray):
+        return numpy.packbits(bitmap, axis=1).tobytes()
+    out = bytearray()
+    for row in bitmap:
+        for x in range(0, width, 8):
+            out.append(sum(0x80 >> i for i, v in enumerate(row[x:x+8]) if v))
+    return bytes(out)
+        
+class TextureCache:
+    # Keeps decoded texture pages in memory, evicting the least recently used
+    # ones when their decoded size goes over the budget
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.pages = OrderedDict()
+        self.__lock = threading.Lock() # The resource server looks pages up from several threads
+    
+    def get(self, tex, source=None):
+        # tex is the path of the page, or just its key when the encoded page
+        # comes from source, a function returning a file object
+        with self.__lock:
+            img = self.pages.get(tex)
+            if img is not None:
+                self.pages.move_to_end(tex)
+                return img
+            img = Image.open(tex if source is None else source())
+            img.load()
+            size = img.width * img.height * len(img.getbands())
+            while self.pages and self.used + size > self.budget:
+                old_tex, old_img = self.pages.popitem(last=False)
+                self.used -= old_img.width * old_img.height * len(old_img.getbands())
+                logging.debug('evicted texture "%s" from cache', old_tex)
+            self.pages[tex] = img
+            self.used += size
+            return img
+        
+def saveBlob(data_file, fname, offset, length, manifest=None, dedup=None):
+    digest = None
+    if manifest is not None or dedup is not None:
+        digest = sha1_at(data_file, offset, length)
+    if manifest is not None and manifest.unchanged(fname, size=length, sha1=digest):
+        if dedup is not None:
+            dedup.register(digest, fname)
+        return
+    def write():
+        if Section.ARCHIVE is not None:
+            Section.ARCHIVE.copy(fname, data_file, offset, length)
+            return
+        with Section.open(fname) as f:
+            data_file.copyTo(f, offset, length)
+    original = None
+    if dedup is not None:
+        if os.path.lexists(fname): # It may be a link to another file from a previous run
+            os.remove(fname)
+        original = dedup.write(digest, fname, write)
+    else:
+        write()
+    if manifest is not None:
+        record = {'offset':offset, 'size':length, 'sha1':digest}
+        if original is not None:
+            record['alias'] = manifest.key(original)
+        manifest.update(fname, **record)
+        
+def saveImage(img, path, dedup=None):
+    # Identical images are linked to the first one instead of being encoded again
+    if dedup is None:
+        with Section.open(path) as f:
+            img.save(f, 'PNG')
+        return
+    if os.path.lexists(path):
+        os.remove(path)
+    digest = hashlib.sha1(repr((img.mode, img.size)).encode('ascii') + img.tobytes())
+    dedup.write(digest.hexdigest(), path, lambda: img.save(path, 'PNG'))
+        
+def cropImage(img, crops, dedup=None):
+    # Saves every (box, path) crop of the image
+    for box, path in crops:
+        saveImage(img.crop(box), path, dedup)
+    return len(crops)
+        
+def cropTexture(tex, crops, dedup=False):
+    # Runs in a worker process, crops is a list of (box, path) tuples
+    img = Image.open(tex)
+    img.load()
+    return cropImage(img, crops, Deduplicator() if dedup else None)
+        
+def sheetLayout(frames, layout):
+    # Cells are as big as the largest frame, returns the size of the sheet and
+    # the position of every frame
+    width = max(box[2]-box[0] for tid, box in frames)
+    height = max(box[3]-box[1] for tid, box in frames)
+    cols = len(frames) if layout == 'strip' else math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / cols)
+    return (cols*width, rows*height), [((i % cols)*width, (i // cols)*height) for i in range(len(frames))]
+        
+def buildSheets(sheets, texture_dir, layout, cache_size, dedup=False, source=None):
+    # Also runs in worker processes, sheets is a list of (path, frames) tuples.
+    # source(path) returns a function opening a texture page not on disk.
+    cache = TextureCache(cache_size)
+    dedup = Deduplicator() if dedup else None
+    for path, frames in sheets:
+        size, positions = sheetLayout(frames, layout)
+        sheet = Image.new('RGBA', size)
+        for (tid, box), pos in zip(frames, positions):
+            tex = os.path.join(texture_dir, 'tex'+str(tid)+'.png')
+            sheet.paste(cache.get(tex, source(tex) if source is not None else None).crop(box), pos)
+        saveImage(sheet, path, dedup)
+    return len(sheets)
         
 def setIgnores(ignore):
     __IGNORES = []
@@ -530,12 +1239,206 @@ def setIgnores(ignore):
     Section.IGNORES = __IGNORES
     
 
-def load(path, output_dir='.'):
-    with FileReadStream(path) as fs:
+def setOnly(patterns):
+    Section.ONLY = list(patterns)
+    
+class Options:
+    # Every setting of an extraction run, so a run doesn't depend on what the
+    # module flags were left at. The defaults are taken from the module flags.
+    _FLAGS = {
+        'convert':'CONVERT_RESOURCES',
+        'metadata_format':'METADATA_FORMAT',
+        'threads':'THREADS',
+        'mask_format':'MASK_FORMAT',
+        'jobs':'JOBS',
+        'texture_cache_size':'TEXTURE_CACHE_SIZE',
+        'mmap':'USE_MMAP',
+        'lazy':'LAZY_LOAD',
+        'index_cache':'USE_INDEX_CACHE',
+        'incremental':'INCREMENTAL',
+        'dedup':'DEDUP',
+        'profile':'PROFILE',
+        'archive':'ARCHIVE',
+        'sheet_layout':'SHEET_LAYOUT',
+        }
+    
+    def __init__(self, **kwargs):
+        self.ignore = None # Resource kinds as given to setIgnores, None keeps Section.IGNORES
+        self.only = None # Name patterns as given to setOnly, None keeps Section.ONLY
+        for name, flag in self._FLAGS.items():
+            setattr(self, name, globals()[flag])
+        for name, value in kwargs.items():
+            if name not in self._FLAGS and name not in ('ignore', 'only'):
+                raise TypeError('Unknown option '+name)
+            setattr(self, name, value)
+            
+    @contextmanager
+    def applied(self):
+        # Sets the module flags for the duration of a run and restores them afterwards
+        module = globals()
+        saved = ({flag:module[flag] for flag in self._FLAGS.values()}, Section.IGNORES, Section.ONLY)
+        for name, flag in self._FLAGS.items():
+            module[flag] = getattr(self, name)
+        if self.ignore is not None:
+            setIgnores(self.ignore)
+        if self.only is not None:
+            setOnly(self.only)
+        try:
+            yield self
+        finally:
+            module.update(saved[0])
+            Section.IGNORES, Section.ONLY = saved[1], saved[2]
+    
+def openStream(path):
+    if USE_MMAP:
+        return MmapReadStream(path)
+    return FileReadStream(path)
+
+def fileKey(path):
+    # Size and modification time identify the file, hashing all of it would
+    # cost more than parsing it. The hash only covers the chunk directory and
+    # both ends of the file, to catch copies sharing size and time.
+    st = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        digest.update(header)
+        end = 8 + struct.unpack('<i', header[4:])[0] if len(header) == 8 else 0
+        while f.tell() + 8 <= min(end, st.st_size):
+            chunk = f.read(8)
+            digest.update(chunk)
+            f.seek(struct.unpack('<i', chunk[4:])[0], os.SEEK_CUR)
+        f.seek(0)
+        digest.update(f.read(INDEX_SAMPLE_SIZE))
+        f.seek(max(0, st.st_size - INDEX_SAMPLE_SIZE))
+        digest.update(f.read(INDEX_SAMPLE_SIZE))
+    return {'size':st.st_size, 'mtime':st.st_mtime_ns, 'sha1':digest.hexdigest()}
+
+def readIndexCache(path, output_dir):
+    index_file = os.path.join(output_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            cache = json.load(f)
+    except ValueError:
+        logging.warning('Discarding unreadable index cache '+index_file)
+        return None
+    st = os.stat(path)
+    key = cache.get('key', {})
+    if (cache.get('version') != INDEX_VERSION or key.get('size') != st.st_size or
+            key.get('mtime') != st.st_mtime_ns or key != fileKey(path)):
+        logging.info('Index cache is stale, the file will be parsed again')
+        return None
+    return cache['index']
+
+def writeIndexCache(path, output_dir, data):
+    index_file = os.path.join(output_dir, INDEX_FILE)
+    cache = {'version':INDEX_VERSION, 'key':fileKey(path), 'index':data.dumpIndex()}
+    with open(index_file, 'w') as f:
+        json.dump(cache, f, separators=(',', ':'))
+    logging.info('Saved file index into '+index_file)
+
+class Resource:
+    # A resource of the data file as handed out by iterResources, its bytes
+    # are only read when asked for
+    __slots__ = ('kind', 'name', 'offset', 'size', 'fs')
+    
+    def __init__(self, kind, name, offset, size, fs):
+        self.kind = kind # audio, texture or sprite
+        self.name = name # Name of the file gmk.load would save it into
+        self.offset = offset
+        self.size = size
+        self.fs = fs
+        
+    def read(self):
+        return bytes(self.fs.read_at(self.offset, self.size))
+    
+    def image(self):
+        return Image.open(io.BytesIO(self.read()))
+    
+    def __repr__(self):
+        return str.format('<{cls:} kind={kind:}, name={name:}, offset={offset:d}, size={size:d}>',
+                          cls=self.__class__.__name__, kind=self.kind, name=self.name,
+                          offset=self.offset, size=self.size)
+        
+class SpriteFrame(Resource):
+    # A sprite sub-image, offset and size locate the texture page it's cropped from
+    __slots__ = ('sprite', 'frame', 'texture_id', 'box', 'cache')
+    
+    def __init__(self, sprite, frame, texture_id, box, page, fs, cache):
+        Resource.__init__(self, 'sprite', sprite+'_'+str(frame)+'.png', page.image_offset, page.image_size, fs)
+        self.sprite = sprite
+        self.frame = frame
+        self.texture_id = texture_id
+        self.box = box
+        self.cache = cache # Decoded pages shared by all the frames
+        
+    def image(self):
+        page = self.cache.get(self.texture_id, lambda: io.BytesIO(Resource.read(self)))
+        return page.crop(self.box)
+    
+    def read(self):
+        # Encoded the same way as the files in the sprites dir
+        buf = io.BytesIO()
+        self.image().save(buf, 'PNG')
+        return buf.getvalue()
+    
+def iterResources(path, kinds=('audio', 'texture', 'sprite')):
+    # Yields the resources of the data file one at a time without writing
+    # anything to disk. The sections are decoded on demand and the records
+    # read from the data file, so they are only valid while iterating.
+    with openStream(path) as fs:
         d = Data()
-        d.load(fs)
-        d.saveResources(output_dir, fs)
+        d.load(fs, lazy=True)
+        yield from d.resources(fs, kinds)
+    
+def load(path, output_dir='.', options=None):
+    if options is not None:
+        with options.applied():
+            return load(path, output_dir)
+    if ARCHIVE is not None and (INCREMENTAL or DEDUP or JOBS > 1):
+        # The archive is written again on every run by this process alone
+        logging.warning('Ignoring the incremental, dedup and jobs options when writing into an archive')
+        with Options(incremental=False, dedup=False, jobs=1).applied():
+            return load(path, output_dir)
+    Section.PROFILER = Profiler() if PROFILE else None
+    if ARCHIVE is not None:
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        Section.ARCHIVE = ArchiveWriter(ARCHIVE, output_dir)
+    try:
+        extract(path, output_dir)
+    finally:
+        if Section.ARCHIVE is not None:
+            Section.ARCHIVE.close()
+            logging.info('Saved {0} files into {1}'.format(len(Section.ARCHIVE.sizes), ARCHIVE))
+            Section.ARCHIVE = None
+    if PROFILE:
+        report = os.path.join(output_dir, 'profile.json')
+        Section.PROFILER.save(report)
+        logging.info('Saved profile report into '+report)
+        
+def extract(path, output_dir):
+    with openStream(path) as fs:
+        if PROFILE:
+            fs = ProfiledStream(fs, Section.PROFILER)
+        d = Data()
+        with Section.profile('parse'):
+            index = readIndexCache(path, output_dir) if USE_INDEX_CACHE else None
+            if index is not None:
+                d.loadIndex(index, fs, LAZY_LOAD)
+            else:
+                d.load(fs, LAZY_LOAD)
+        manifest = Manifest(output_dir) if INCREMENTAL else None
+        with Section.profile('export'):
+            d.saveResources(output_dir, fs, THREADS, manifest)
+        if USE_INDEX_CACHE and index is None:
+            writeIndexCache(path, output_dir, d)
         if CONVERT_RESOURCES:
-            d.convertResources(output_dir, fs)
+            with Section.profile('convert'):
+                d.convertResources(output_dir, fs, manifest)
+        if manifest is not None:
+            manifest.save()
         
     
\ No newline at end of file
@@ -0,0 +1,91 @@
+import os
+import copy
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import gmk
+
+DATA_EXTENSIONS = ('.win', '.unx', '.ios', '.droid')
+
+def collectInputs(paths):
+    # Directories are searched for data files (data.win, game.unx...), files are taken as is
+    inputs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            inputs.append((path, os.path.splitext(os.path.basename(path))[0]))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() in DATA_EXTENSIONS:
+                    # Output dir mirrors the layout found under the searched dir
+                    rel = os.path.relpath(os.path.join(root, stem), path)
+                    inputs.append((os.path.join(root, name), os.path.join(os.path.basename(os.path.abspath(path)), rel)))
+    return inputs
+
+def outputDirs(inputs, output_root):
+    # Every input gets its own dir under the output root, numbered if two of them collide
+    dirs = []
+    used = set()
+    for path, name in inputs:
+        out = os.path.join(output_root, name)
+        i = 1
+        while out in used:
+            i += 1
+            out = os.path.join(output_root, name+'-'+str(i))
+        used.add(out)
+        dirs.append(out)
+    return dirs
+
+def jobOptions(options, output_dir):
+    # Every job gets an archive of its own next to its output dir, the given
+    # archive name only picks the format
+    if options.archive is None:
+        return options
+    options = copy.copy(options)
+    options.archive = output_dir + os.path.splitext(options.archive)[1]
+    return options
+
+def runJob(path, output_dir, options):
+    # Runs inside the worker process, the options only apply to this extraction
+    start = time.perf_counter()
+    error = None
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        gmk.load(path, output_dir, options)
+    except Exception as e:
+        logging.exception('Failed to extract '+path)
+        error = str(e) or e.__class__.__name__
+    return {'path':path, 'output':output_dir, 'seconds':time.perf_counter() - start,
+            'size':os.path.getsize(path) if os.path.exists(path) else 0, 'error':error}
+
+def extractAll(inputs, output_root, options=None, processes=None):
+    if options is None:
+        options = gmk.Options()
+    # The jobs already run in parallel, nested process pools would only compete for the same cores
+    if processes != 1 and options.jobs > 1:
+        logging.info('Ignoring --jobs inside the batch workers')
+        options = copy.copy(options)
+        options.jobs = 1
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(runJob, path, out, jobOptions(options, out))
+                   for (path, name), out in zip(inputs, outputDirs(inputs, output_root))]
+        for future in as_completed(futures):
+            result = future.result()
+            if result['error'] is None:
+                logging.info('Extracted {0} into {1} in {2:.2f}s'.format(result['path'], result['output'],
+                                                                         result['seconds']))
+            else:
+                logging.error('Could not extract {0}: {1}'.format(result['path'], result['error']))
+            results.append(result)
+    elapsed = time.perf_counter() - start
+    done = [r for r in results if r['error'] is None]
+    size = sum(r['size'] for r in done)
+    logging.info('### Extracted {0} of {1} files, {2:.1f} MB in {3:.2f}s ({4:.1f} MB/s, {5:.2f} files/s) ###'
+                 .format(len(done), len(results), size / 2**20, elapsed,
+                         size / 2**20 / elapsed if elapsed else 0, len(done) / elapsed if elapsed else 0))
+    return results
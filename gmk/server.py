@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import mimetypes
+from urllib.parse import unquote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import gmk
+
+ROUTES = ('sprite', 'audio', 'texture', 'metrics')
+REASONS = {200:'OK', 400:'Bad Request', 404:'Not Found', 405:'Method Not Allowed', 500:'Internal Server Error'}
+MAX_BODY_SIZE = 1024 * 1024 # Larger request bodies aren't read, the connection is closed instead
+
+class RouteMetrics:
+    # Response times of a route, in milliseconds
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, status, size, elapsed):
+        self.count += 1
+        if status != 200:
+            self.errors += 1
+        self.bytes += size
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def report(self):
+        return {'requests':self.count, 'errors':self.errors, 'bytes':self.bytes,
+                'mean_ms':round(self.total / self.count, 3) if self.count else 0, 'max_ms':round(self.max, 3)}
+
+
+class ResourceServer:
+    # Serves single resources of a data file over HTTP. The file is opened and
+    # its sections indexed once, every request only reads the bytes it needs
+    # and the decoded texture pages are kept in a TextureCache between requests.
+    def __init__(self, path, threads=4):
+        self.path = path
+        self.fs = gmk.openStream(path)
+        self.data = gmk.Data()
+        self.data.load(self.fs, lazy=True)
+        self.cache = gmk.TextureCache(gmk.TEXTURE_CACHE_SIZE)
+        self.audio = {}
+        self.textures = {}
+        self.sprites = {}
+        for res in self.data.resources(self.fs, cache=self.cache):
+            if res.kind == 'audio':
+                self.audio[res.name] = res
+                self.audio.setdefault(os.path.splitext(res.name)[0], res)
+            elif res.kind == 'texture':
+                self.textures[res.name[3:-4]] = res # texN.png
+            else:
+                self.sprites[(res.sprite, str(res.frame))] = res
+        self.metrics = {}
+        self.started = time.time()
+        # PNG encoding and positional reads run off the event loop
+        self.executor = ThreadPoolExecutor(threads)
+        logging.info('Indexed {0} sounds, {1} textures and {2} sprite frames of {3}'.format(
+            len(set(self.audio.values())), len(self.textures), len(self.sprites), path))
+
+    def close(self):
+        self.executor.shutdown()
+        self.fs.close()
+
+    def find(self, route, args):
+        # Returns the resource asked for or None
+        if route == 'sprite' and len(args) == 2:
+            return self.sprites.get(tuple(args))
+        if route == 'audio' and len(args) == 1:
+            return self.audio.get(args[0])
+        if route == 'texture' and len(args) == 1:
+            return self.textures.get(args[0])
+        return None
+
+    def report(self):
+        return {'file':self.path, 'uptime':round(time.time() - self.started, 3),
+                'cached_pages':len(self.cache.pages), 'cached_bytes':self.cache.used,
+                'routes':{route:m.report() for route, m in sorted(self.metrics.items())}}
+
+    async def respond(self, method, target):
+        # Returns status, content type, body and content length, the body is
+        # None when answering a HEAD request without extracting anything
+        parts = [unquote(p) for p in urlsplit(target).path.split('/') if p]
+        if method not in ('GET', 'HEAD'):
+            return 405, 'text/plain', b'Only GET and HEAD are supported\n', None
+        if parts == ['metrics']:
+            return 200, 'application/json', json.dumps(self.report(), indent=2).encode('utf-8'), None
+        res = self.find(parts[0], parts[1:]) if parts else None
+        if res is None:
+            return 404, 'text/plain', b'No such resource\n', None
+        ctype = mimetypes.guess_type(res.name)[0] or 'application/octet-stream'
+        if method == 'HEAD' and res.kind != 'sprite':
+            # The stored size is exact, sprite frames are only known once encoded
+            return 200, ctype, None, res.size
+        body = await asyncio.get_running_loop().run_in_executor(self.executor, res.read)
+        return 200, ctype, body, None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                start = time.perf_counter()
+                lines = head.decode('iso-8859-1').split('\r\n')
+                request = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                keep_alive = len(request) == 3 and request[2] == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                # Any request body is read and dropped, left in the stream it
+                # would be parsed as the next request
+                drained = await self.drain(reader, headers)
+                if not drained:
+                    keep_alive = False
+                if len(request) != 3 or drained is None:
+                    method, target = '', '/'
+                    status, ctype, body, length = 400, 'text/plain', b'Malformed request\n', None
+                else:
+                    method, target, version = request
+                    try:
+                        status, ctype, body, length = await self.respond(method, target)
+                    except Exception:
+                        logging.exception('Failed to serve '+target)
+                        status, ctype, body, length = 500, 'text/plain', b'Extraction failed\n', None
+                if length is None:
+                    length = len(body)
+                elapsed = (time.perf_counter() - start) * 1000
+                writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: {2}\r\nContent-Length: {3}\r\n'
+                             'Server-Timing: extract;dur={4:.3f}\r\nConnection: {5}\r\n\r\n'
+                             .format(status, REASONS[status], ctype, length, elapsed,
+                                     'keep-alive' if keep_alive else 'close').encode('ascii'))
+                sent = 0
+                if method != 'HEAD':
+                    writer.write(body)
+                    sent = len(body)
+                await writer.drain()
+                route = urlsplit(target).path.strip('/').split('/')[0]
+                self.metrics.setdefault(route if route in ROUTES else 'other', RouteMetrics()).add(
+                    status, sent, elapsed)
+                logging.info('{0} {1} {2} {3:.2f}ms'.format(method, target, status, elapsed))
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def drain(self, reader, headers):
+        # Reads the request body. Returns True when the connection can be kept
+        # open afterwards, False when the body was left unread and None when
+        # the length is malformed.
+        if 'transfer-encoding' in headers: # Chunked bodies aren't supported
+            return False
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            return None
+        if length < 0:
+            return None
+        if length > MAX_BODY_SIZE:
+            return False
+        if length:
+            try:
+                await reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return False
+        return True
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info('Serving {0} on http://{1}:{2}/'.format(self.path, host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def serve(path, host='127.0.0.1', port=8080, threads=4):
+    server = ResourceServer(path, threads)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        logging.info('Server stopped')
+    finally:
+        server.close()
@@ -1,11 +1,27 @@
 import logging
 import struct
+import mmap
 import os
+import io
+import sys
+import json
+import threading
+import hashlib
+import base64
+import shutil
+import time
+import zipfile
+import tarfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from xml.sax.saxutils import escape
 
 class FileStream:
     def __init__(self, path, file_obj):
         self.__path = path
         self.__file_obj = file_obj
+        self.strings = {} # STRG pointers already resolved, mapped to interned strings
 
     def __enter__(self):
         return self
@@ -25,8 +41,17 @@ class FileStream:
 class FileReadStream(FileStream):
     def __init__(self, path):
         self.__fin = open(path, 'rb')
+        self.__lock = threading.Lock()
+        self.__positional = None # Second handle for the positional reads when there is no pread
         FileStream.__init__(self, path, self.__fin)
         
+    def close(self):
+        with self.__lock:
+            if self.__positional is not None:
+                self.__positional.close()
+                self.__positional = None
+        FileStream.close(self)
+        
     def moveToOffset(self, off):
         self.__fin.seek(off)
     
@@ -44,12 +69,7 @@ class FileReadStream(FileStream):
         return str(tag, 'cp437')
     
     def readOffsetStr(self):
-        offset = self.readInt()
-        curoff = self.__fin.tell() #Save the current offset
-        self.__fin.seek(offset-4)
-        s = self.readStr()
-        self.__fin.seek(curoff) #Go back to the current offset before continue
-        return s
+        return self.str_at(self.readInt())
     
     # READ methods for general types
     def readInt(self):
@@ -73,7 +93,687 @@ class FileReadStream(FileStream):
 
     def readBytes(self, length):
         return self.__fin.read(length)
-    
+
+    def readInts(self, count):
+        return int_array(self.__fin.read(4*count))
+
+    def copyTo(self, fout, offset, length):
+        # Copy a blob straight into fout without holding it in memory
+        # Only positional reads are used so it can be called from several threads
+        copied = kernel_copy(self.__fin.fileno(), fout, offset, length)
+        offset += copied
+        length -= copied
+        while length > 0:
+            buf = self.read_at(offset, min(length, COPY_CHUNK_SIZE))
+            if not buf:
+                break
+            fout.write(buf)
+            offset += len(buf)
+            length -= len(buf)
+
+    # Positional READ methods, they don't move the cursor so they are safe to
+    # use from several threads at once
+    def read_at(self, offset, n):
+        if hasattr(os, 'pread'):
+            return os.pread(self.__fin.fileno(), n, offset)
+        # No pread (Windows). The cursor of the main handle belongs to the
+        # parser, which may be decoding a section on another thread, so these
+        # reads seek a handle of their own
+        with self.__lock:
+            if self.__positional is None:
+                self.__positional = open(self.path(), 'rb')
+            self.__positional.seek(offset)
+            return self.__positional.read(n)
+
+    def int_at(self, offset):
+        v, = struct.unpack('<i', self.read_at(offset, 4))
+        return v
+
+    def str_at(self, offset):
+        # offset points at the characters, the length is stored right before them
+        s = self.strings.get(offset)
+        if s is None:
+            length = self.int_at(offset-4)
+            s = sys.intern(str(self.read_at(offset, length), 'cp437'))
+            self.strings[offset] = s
+        return s
+
+
+class MmapReadStream(FileStream):
+    # Same interface as FileReadStream, but the whole file is memory mapped and
+    # read through a cursor, so no syscall is issued per field and readBytes
+    # hands back zero-copy memoryview slices instead of new bytes objects.
+    def __init__(self, path):
+        self.__fin = open(path, 'rb')
+        FileStream.__init__(self, path, self.__fin)
+        self.__map = mmap.mmap(self.__fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__view = memoryview(self.__map)
+        self.__pos = 0
+
+    def close(self):
+        if self.__view is not None:
+            self.__view.release()
+            self.__view = None
+            try:
+                self.__map.close()
+            except BufferError:
+                # Some entry still holds a slice, the map is released with it
+                logging.debug('memory map of "%s" still in use', self.path())
+            self.__map = None
+        FileStream.close(self)
+
+    def moveToOffset(self, off):
+        self.__pos = off
+
+    def skipBytes(self, num):
+        self.__pos += num
+
+    def currOffset(self):
+        return self.__pos
+
+    def readTag(self):
+        buf = self.__map[self.__pos:self.__pos+4]
+        if len(buf) != 4:
+            return 'EOF'
+        self.__pos += 4
+        return str(buf, 'cp437')
+
+    def readOffsetStr(self):
+        return self.str_at(self.readInt())
+
+    # READ methods for general types
+    def readInt(self):
+        v, = struct.unpack_from('<i', self.__map, self.__pos)
+        self.__pos += 4
+        return v
+
+    def readShort(self):
+        v, = struct.unpack_from('<h', self.__map, self.__pos)
+        self.__pos += 2
+        return v
+
+    def readStr(self):
+        length = self.readInt()
+        s = str(self.__map[self.__pos:self.__pos+length], 'cp437')
+        self.__pos += length + 1 # Skip null byte at the end
+        return s
+
+    def readByte(self):
+        v = self.__map[self.__pos]
+        self.__pos += 1
+        return v
+
+    def readBytes(self, length):
+        start = self.__pos
+        self.__pos = min(start + length, len(self.__map))
+        return self.__view[start:self.__pos]
+
+    def readInts(self, count):
+        return int_array(self.readBytes(4*count))
+
+    def copyTo(self, fout, offset, length):
+        copied = kernel_copy(self.__fin.fileno(), fout, offset, length)
+        offset += copied
+        length -= copied
+        while length > 0:
+            buf = self.read_at(offset, min(length, COPY_CHUNK_SIZE))
+            if len(buf) == 0:
+                break
+            fout.write(buf)
+            offset += len(buf)
+            length -= len(buf)
+
+    # Positional READ methods, they don't move the cursor
+    def read_at(self, offset, n):
+        return self.__view[offset:offset+n]
+
+    def int_at(self, offset):
+        v, = struct.unpack_from('<i', self.__map, offset)
+        return v
+
+    def str_at(self, offset):
+        s = self.strings.get(offset)
+        if s is None:
+            length = self.int_at(offset-4)
+            s = sys.intern(str(self.__map[offset:offset+length], 'cp437'))
+            self.strings[offset] = s
+        return s
+
+class XmlMetadataWriter:
+    # Writes the metadata entries as soon as they are produced, the output is
+    # laid out the same way minidom's toprettyxml used to do it
+    def __init__(self, path, root, opener=None):
+        # opener(path) returns the binary file to write into, a plain file by default
+        self.path = path + '.xml'
+        self.root = root
+        self.count = 0
+        self.__fout = opener(self.path) if opener is not None else open(self.path, 'wb')
+        self.__write(0, '<?xml version="1.0" encoding="utf-8"?>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __write(self, level, text):
+        self.__fout.write(('  '*level + text + os.linesep).encode('utf-8'))
+
+    def __tag(self, tag, attrib, end=''):
+        attrs = ''.join(' {0}="{1}"'.format(k, escape(str(v), {'"':'&quot;'}))
+                        for k, v in attrib.items())
+        return '<' + tag + attrs + end + '>'
+
+    def writeEntry(self, tag, attrib, lists=None):
+        # lists maps a child element to an (item tag, item attribute, values) tuple
+        if self.count == 0:
+            self.__write(0, '<' + self.root + '>')
+        self.count += 1
+        if not lists:
+            self.__write(1, self.__tag(tag, attrib, '/'))
+            return
+        self.__write(1, self.__tag(tag, attrib))
+        for name, (item, attr, values) in lists.items():
+            if len(values) == 0:
+                self.__write(2, '<' + name + '/>')
+                continue
+            self.__write(2, '<' + name + '>')
+            for v in values:
+                self.__write(3, self.__tag(item, {attr:v}, '/'))
+            self.__write(2, '</' + name + '>')
+        self.__write(1, '</' + tag + '>')
+
+    def close(self):
+        if self.__fout is not None:
+            self.__write(0, '</' + self.root + '>' if self.count else '<' + self.root + '/>')
+            self.__fout.close()
+            self.__fout = None
+
+
+class JsonLinesMetadataWriter:
+    # One JSON object per line, the child lists become plain arrays
+    def __init__(self, path, root, opener=None):
+        self.path = path + '.jsonl'
+        self.root = root
+        self.count = 0
+        if opener is not None:
+            self.__fout = io.TextIOWrapper(opener(self.path), encoding='utf-8')
+        else:
+            self.__fout = open(self.path, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writeEntry(self, tag, attrib, lists=None):
+        record = dict(attrib)
+        if lists:
+            for name, (item, attr, values) in lists.items():
+                record[name] = list(values)
+        self.__fout.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.__fout is not None:
+            self.__fout.close()
+            self.__fout = None
+
+
+class ExportScheduler:
+    # Runs write jobs on a pool of threads. At most queue_size jobs are pending
+    # at any time, submit blocks until a slot is free. With a single thread the
+    # jobs just run in place.
+    def __init__(self, threads=1, queue_size=None):
+        self.threads = threads
+        self.__pool = None
+        self.__errors = []
+        if threads > 1:
+            self.__pool = ThreadPoolExecutor(max_workers=threads)
+            self.__slots = threading.BoundedSemaphore(queue_size or threads*4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, func, *args):
+        if self.__pool is None:
+            func(*args)
+            return
+        self.__slots.acquire()
+        future = self.__pool.submit(func, *args)
+        future.add_done_callback(self.__done)
+
+    def __done(self, future):
+        self.__slots.release()
+        if future.exception() is not None:
+            self.__errors.append(future.exception())
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+            self.__pool = None
+        if self.__errors:
+            raise self.__errors[0]
+
+
+class Manifest:
+    # Remembers what every output file was made from (source offset, size,
+    # content hash...) so an unchanged file doesn't have to be written again.
+    # Paths are stored relative to the output dir.
+    def __init__(self, base_dir, name='manifest.json'):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, name)
+        self.entries = {}
+        self.__lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.warning('Discarding unreadable manifest '+self.path)
+
+    def key(self, fname):
+        return os.path.relpath(fname, self.base_dir).replace(os.sep, '/')
+
+    def get(self, fname):
+        with self.__lock:
+            return self.entries.get(self.key(fname))
+
+    def unchanged(self, fname, **fields):
+        # True when fname is still on disk and was made from the same fields
+        old = self.get(fname)
+        if old is None or not os.path.exists(fname):
+            return False
+        return all(old.get(k) == v for k, v in fields.items())
+
+    def update(self, fname, **fields):
+        with self.__lock:
+            self.entries[self.key(fname)] = fields
+
+    def digest(self, fname):
+        # Content hash of an output file, the recorded one if there is any
+        record = self.get(fname)
+        if record is not None and 'sha1' in record:
+            return record['sha1']
+        digest = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save(self):
+        with self.__lock:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+
+
+class Deduplicator:
+    # Maps content hashes to the first file written with that content, the
+    # following files with the same content are hard linked to it
+    def __init__(self):
+        self.linked = 0
+        self.__files = {}
+        self.__lock = threading.Lock()
+
+    def register(self, digest, fname):
+        # fname is already on disk with that content
+        with self.__lock:
+            if digest not in self.__files:
+                done = threading.Event()
+                done.set()
+                self.__files[digest] = (fname, done)
+
+    def write(self, digest, fname, writer):
+        # Calls writer() if it's the first time this content is seen, otherwise
+        # waits for the original to be written and links to it. Returns the
+        # path of the original or None.
+        with self.__lock:
+            original = self.__files.get(digest)
+            if original is None:
+                done = threading.Event()
+                self.__files[digest] = (fname, done)
+        if original is None:
+            try:
+                writer()
+            finally:
+                done.set()
+            return None
+        path, done = original
+        done.wait()
+        link_file(path, fname)
+        with self.__lock:
+            self.linked += 1
+        return path
+
+
+class ArchiveWriter:
+    # Puts the output files into a single zip or tar archive instead of the
+    # output dir, members are named after their path relative to base_dir.
+    # PNG and OGG data is already compressed, so it's stored as is.
+    STORED = ('.png', '.ogg')
+
+    def __init__(self, path, base_dir):
+        self.path = path
+        self.base_dir = base_dir
+        self.sizes = {} # Size of every member written so far
+        self.__sources = {} # Members copied from the data file, mapped to (data file, offset, length)
+        self.__lock = threading.Lock()
+        self.__zip = None
+        self.__tar = None
+        if path.lower().endswith('.zip'):
+            self.__zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        elif path.lower().endswith('.tar'):
+            self.__tar = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+        else:
+            raise Exception('Unknown archive format, expected a .zip or .tar file: '+path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def name(self, path):
+        return os.path.relpath(path, self.base_dir).replace(os.sep, '/')
+
+    def __zipInfo(self, name):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        stored = os.path.splitext(name)[1].lower() in self.STORED
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        return info
+
+    def __addTar(self, name, fileobj, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        self.__tar.addfile(info, fileobj)
+
+    def add(self, path, data):
+        name = self.name(path)
+        with self.__lock:
+            if self.__zip is not None:
+                self.__zip.writestr(self.__zipInfo(name), data)
+            else:
+                self.__addTar(name, io.BytesIO(data), len(data))
+            self.sizes[name] = len(data)
+
+    def copy(self, path, data_file, offset, length):
+        # Streams a blob of the data file into a member, writes are serialized
+        # since the archive is a single file
+        name = self.name(path)
+        with self.__lock:
+            if self.__zip is not None:
+                with self.__zip.open(self.__zipInfo(name), 'w', force_zip64=length >= zipfile.ZIP64_LIMIT) as f:
+                    data_file.copyTo(f, offset, length)
+            else:
+                self.__addTar(name, BlobReader(data_file, offset, length), length)
+            self.sizes[name] = length
+            self.__sources[name] = (data_file, offset, length)
+
+    def open(self, path):
+        # A file object whose content is added to the archive when it's closed
+        return ArchiveMember(self, path)
+
+    def source(self, path):
+        # Returns a function reopening a member copied from the data file, or
+        # None, the archive itself can't be read while it's being written
+        src = self.__sources.get(self.name(path))
+        if src is None:
+            return None
+        data_file, offset, length = src
+        return lambda: io.BytesIO(data_file.read_at(offset, length))
+
+    def close(self):
+        with self.__lock:
+            if self.__zip is not None:
+                self.__zip.close()
+                self.__zip = None
+            if self.__tar is not None:
+                self.__tar.close()
+                self.__tar = None
+
+
+class BlobReader(io.RawIOBase):
+    # Read only file object over a blob of the data file, it's read in chunks
+    # of at most COPY_CHUNK_SIZE with positional reads
+    def __init__(self, data_file, offset, length):
+        io.RawIOBase.__init__(self)
+        self.__fs = data_file
+        self.__offset = offset
+        self.__left = length
+
+    def readable(self):
+        return True
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > COPY_CHUNK_SIZE:
+            n = COPY_CHUNK_SIZE
+        n = min(n, self.__left)
+        if n <= 0:
+            return b''
+        buf = bytes(self.__fs.read_at(self.__offset, n))
+        self.__offset += len(buf)
+        self.__left -= len(buf) if buf else self.__left
+        return buf
+
+
+class ArchiveMember(io.BytesIO):
+    def __init__(self, archive, path):
+        io.BytesIO.__init__(self)
+        self.__archive = archive
+        self.__path = path
+
+    def close(self):
+        if not self.closed:
+            self.__archive.add(self.__path, self.getvalue())
+        io.BytesIO.close(self)
+
+
+def link_file(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError: # Hard links not supported here, make a copy instead
+        shutil.copyfile(src, dst)
+
+def sha1_at(fs, offset, length):
+    # Content hash of a blob inside the data file, read with positional reads
+    digest = hashlib.sha1()
+    while length > 0:
+        buf = fs.read_at(offset, min(length, COPY_CHUNK_SIZE))
+        if len(buf) == 0:
+            break
+        digest.update(buf)
+        offset += len(buf)
+        length -= len(buf)
+    return digest.hexdigest()
+
+
+class Profiler:
+    # Collects wall time, bytes read, seeks and bytes written for every
+    # measured (phase, section) pair. The counters are updated by
+    # ProfiledStream and by the exporters.
+    def __init__(self):
+        self.bytes_read = 0
+        self.seeks = 0
+        self.bytes_written = 0
+        self.records = []
+        self.__lock = threading.Lock()
+
+    def read(self, n):
+        with self.__lock:
+            self.bytes_read += n
+
+    def seek(self):
+        with self.__lock:
+            self.seeks += 1
+
+    def wrote(self, n):
+        with self.__lock:
+            self.bytes_written += n
+
+    @contextmanager
+    def measure(self, phase, section=None):
+        start = (time.perf_counter(), self.bytes_read, self.seeks, self.bytes_written)
+        try:
+            yield
+        finally:
+            self.records.append({'phase':phase, 'section':section,
+                                 'wall_time':time.perf_counter() - start[0],
+                                 'bytes_read':self.bytes_read - start[1],
+                                 'seeks':self.seeks - start[2],
+                                 'bytes_written':self.bytes_written - start[3]})
+
+    def report(self):
+        return {'bytes_read':self.bytes_read, 'seeks':self.seeks,
+                'bytes_written':self.bytes_written, 'records':self.records}
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class ProfiledStream:
+    # Wraps a read stream and reports every read and cursor move to a Profiler,
+    # only used in profile mode so the normal streams pay nothing for it
+    def __init__(self, fs, profiler):
+        self.__fs = fs
+        self.__profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.__fs, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def moveToOffset(self, off):
+        self.__profiler.seek()
+        self.__fs.moveToOffset(off)
+
+    def skipBytes(self, num):
+        self.__profiler.seek()
+        self.__fs.skipBytes(num)
+
+    def readTag(self):
+        self.__profiler.read(4)
+        return self.__fs.readTag()
+
+    def readOffsetStr(self):
+        known = len(self.__fs.strings)
+        s = self.__fs.readOffsetStr()
+        # The string itself is only read when it wasn't memoized yet
+        self.__profiler.read(4 + (len(s) + 4 if len(self.__fs.strings) != known else 0))
+        return s
+
+    def readInt(self):
+        self.__profiler.read(4)
+        return self.__fs.readInt()
+
+    def readShort(self):
+        self.__profiler.read(2)
+        return self.__fs.readShort()
+
+    def readStr(self):
+        s = self.__fs.readStr()
+        self.__profiler.read(len(s) + 5)
+        return s
+
+    def readByte(self):
+        self.__profiler.read(1)
+        return self.__fs.readByte()
+
+    def readBytes(self, length):
+        buf = self.__fs.readBytes(length)
+        self.__profiler.read(len(buf))
+        return buf
+
+    def readInts(self, count):
+        self.__profiler.read(4*count)
+        return self.__fs.readInts(count)
+
+    def copyTo(self, fout, offset, length):
+        self.__profiler.read(length)
+        self.__profiler.wrote(length)
+        self.__fs.copyTo(fout, offset, length)
+
+    def read_at(self, offset, n):
+        buf = self.__fs.read_at(offset, n)
+        self.__profiler.read(len(buf))
+        return buf
+
+    def int_at(self, offset):
+        self.__profiler.read(4)
+        return self.__fs.int_at(offset)
+
+    def str_at(self, offset):
+        known = offset in self.__fs.strings
+        s = self.__fs.str_at(offset)
+        if not known:
+            self.__profiler.read(len(s) + 4)
+        return s
+
+
+METADATA_WRITERS = {
+    'xml':XmlMetadataWriter,
+    'jsonl':JsonLinesMetadataWriter,
+    }
+
+COPY_CHUNK_SIZE = 1 << 20
+
+def kernel_copy(fd, fout, offset, length):
+    # Let the kernel copy the bytes between both files with copy_file_range or
+    # sendfile when available, returns how many bytes were copied that way
+    fout.flush()
+    copied = 0
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while copied < length:
+                count = min(length - copied, COPY_CHUNK_SIZE)
+                if name == 'copy_file_range':
+                    n = func(fd, fout.fileno(), count, offset + copied)
+                else:
+                    n = func(fout.fileno(), fd, offset + copied, count)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            logging.debug('%s not usable (%s)', name, e)
+    return copied
+
+def int_array(buf, typecode='i'):
+    # Decode a buffer of little-endian int32 values in a single pass
+    values = array(typecode)
+    values.frombytes(buf)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def short_array(buf):
+    return int_array(buf, 'h')
+
+def pack_array(values, typecode='i'):
+    # Text form of an int array for the JSON index cache, base64 of its
+    # little-endian bytes decodes much faster than a JSON list
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+def unpack_array(text, typecode='i'):
+    return int_array(base64.b64decode(text), typecode)
+
 def bytes_to_hex(buf):
     return '['+', '.join('{0:#04x}'.format(x) for x in buf)+']'
     
\ No newline at end of file
@@ -4,34 +4,76 @@ import logging
 import argparse
 
 
-if __name__ == '__main__':
-    
-    parser = argparse.ArgumentParser(description='Utility to recover lost resources from GameMaker data.win files')
-    parser.add_argument('input', metavar='<data.win>', 
-                        help='refers to the main resource file usually called with this name.')
-    parser.add_argument('output', metavar='output_dir', nargs='?', default='data',
-                        help='optional base directory for the recovered resources, it defaults to "data"')
+def addOptions(parser):
+    # Extraction options, shared with batch.py
     parser.add_argument('-ignore', nargs='+', choices=['sound', 'textures', 'sprites'],
                         help='specifies which resources should be ignored, therefore not saved to disk')
+    parser.add_argument('--only', action='append', metavar='PATTERN',
+                        help='only extract the resources whose name matches the pattern (Ex. "spr_player*"),'+
+                        ' it can be repeated')
     parser.add_argument('--convert', action='store_true',
                         help='Specifies if the metadata should be processed to get the final resources'+
-                        ' (Ex. get the sprites)')    
-    args=parser.parse_args()    
-    # set up logger
+                        ' (Ex. get the sprites)')
+    parser.add_argument('--metadata-format', choices=['xml', 'jsonl'], default='xml',
+                        help='format of the sprite and texture metadata files, defaults to xml')
+    parser.add_argument('--masks', choices=['png', 'bin'],
+                        help='also export the sprite collision masks as 1-bit PNGs or a single packed file')
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='number of threads used to write the resource files, defaults to 1')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='number of processes used to crop the sprites when converting, defaults to 1')
+    parser.add_argument('--sheets', choices=['strip', 'grid'],
+                        help='when converting, save the frames of every sprite as a single strip or grid image'+
+                        ' and their rectangles into sprite-sheets.json')
+    parser.add_argument('--texture-cache', type=int, default=256, metavar='MB',
+                        help='memory budget for the decoded texture pages when converting, defaults to 256')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory map the data file instead of reading it field by field')
+    parser.add_argument('--lazy', action='store_true',
+                        help='only read the section directory up front and decode sections on demand')
+    parser.add_argument('--cache', action='store_true',
+                        help='save the parsed file index in the output dir and reuse it on later runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep a manifest in the output dir and only rewrite the files whose source changed')
+    parser.add_argument('--dedup', action='store_true',
+                        help='hard link the resources with the same content instead of writing them again')
+    parser.add_argument('--archive', metavar='FILE',
+                        help='write the resources and metadata into a single .zip or .tar archive'+
+                        ' instead of the output dir')
+    parser.add_argument('--profile', action='store_true',
+                        help='save the time, bytes read, seeks and bytes written of every section and phase'+
+                        ' into profile.json in the output dir')
+
+def getOptions(args):
+    return gmk.Options(ignore=args.ignore or [], only=args.only or [], convert=args.convert,
+                       metadata_format=args.metadata_format, mask_format=args.masks,
+                       threads=args.threads, jobs=args.jobs, sheet_layout=args.sheets,
+                       texture_cache_size=args.texture_cache * 1024 * 1024, mmap=args.mmap,
+                       lazy=args.lazy, index_cache=args.cache, incremental=args.incremental,
+                       dedup=args.dedup, profile=args.profile, archive=args.archive)
+
+def setUpLogger():
     root = logging.getLogger()
     root.setLevel(logging.DEBUG)
-    
+
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
     root.addHandler(ch)
-    
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Utility to recover lost resources from GameMaker data.win files')
+    parser.add_argument('input', metavar='<data.win>',
+                        help='refers to the main resource file usually called with this name.')
+    parser.add_argument('output', metavar='output_dir', nargs='?', default='data',
+                        help='optional base directory for the recovered resources, it defaults to "data"')
+    addOptions(parser)
+    args=parser.parse_args()
+    setUpLogger()
+
     path = args.input
     output = args.output
-    if args.ignore is not None:
-        gmk.setIgnores(args.ignore)
-    if args.convert:
-        gmk.CONVERT_RESOURCES = True
-    gmk.load(path, output)
-    
\ No newline at end of file
+    gmk.load(path, output, getOptions(args))
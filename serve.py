@@ -0,0 +1,28 @@
+import gmk
+import argparse
+from gmk.server import serve
+from launch import setUpLogger
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serves the resources of a GameMaker data file over HTTP,'+
+                                     ' extracting them on demand')
+    parser.add_argument('input', metavar='<data.win>',
+                        help='refers to the main resource file usually called with this name.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, defaults to 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on, defaults to 8080')
+    parser.add_argument('--threads', type=int, default=4, metavar='N',
+                        help='number of threads reading and encoding the resources, defaults to 4')
+    parser.add_argument('--texture-cache', type=int, default=256, metavar='MB',
+                        help='memory budget for the decoded texture pages, defaults to 256')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory map the data file instead of reading it field by field')
+    args = parser.parse_args()
+    setUpLogger()
+
+    gmk.TEXTURE_CACHE_SIZE = args.texture_cache * 1024 * 1024
+    gmk.USE_MMAP = args.mmap
+    serve(args.input, args.host, args.port, args.threads)